@@ -1,3 +1,12 @@
+def parse_dates_cached(column, date_format = "%d/%m/%Y"):
+    # Loan dates have very few distinct values, so each distinct string is parsed once and the result is broadcast through the category codes.
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return column
+    categorical = column if isinstance(column.dtype, pd.CategoricalDtype) else column.astype("category")
+    parsed = pd.to_datetime(categorical.cat.categories, format = date_format)
+    values = parsed.take(categorical.cat.codes.to_numpy(), allow_fill = True, fill_value = pd.NaT)
+    return pd.Series(values, index = column.index, name = column.name)
+
 class DataTransform:
     """
     Transforms the data types of the columns in the dataframe.
@@ -21,18 +30,105 @@ class DataTransform:
     change_data_type_datetime(df)
         This function changes the data types of the following columns to datetime64:
         Change ISSUE_DATE, EARLIEST_CREDIT_LINE, LAST_PAYMENT_DATE, NEXT_PAYMENT_DATE, LAST_CREDIT_PULL_DATE to datetime64.
+        Each distinct date string is only parsed once (see parse_dates_cached).
+
+    Columns which already have the right data type are left as they are, so a frame loaded with csv_to_typed_df passes through unchanged.
     """
 
+    CATEGORY_COLUMNS = ["term", "grade", "sub_grade", "employment_length", "home_ownership", "verification_status", "loan_status", "payment_plan", "purpose", "application_type"]
+    DATETIME_COLUMNS = ["issue_date", "earliest_credit_line", "last_payment_date", "next_payment_date", "last_credit_pull_date"]
+
     # Class constructor
     def __init__(self, df):
         self.df = df
 
     # Methods
     def change_data_type_category(self, df):
-        for column in ["term", "grade", "sub_grade", "employment_length", "home_ownership", "verification_status", "loan_status", "payment_plan", "purpose", "application_type"]:
-            df[column] = df[column].astype("category")
+        for column in self.CATEGORY_COLUMNS:
+            if not isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype("category")
         return df
     def change_data_type_datetime(self, df):
-        for column in ["issue_date", "earliest_credit_line", "last_payment_date", "next_payment_date", "last_credit_pull_date"]:
-            df[column] = pd.to_datetime(df[column], format = "%d/%m/%Y")
-        return df
\ No newline at end of file
+        for column in self.DATETIME_COLUMNS:
+            df[column] = parse_dates_cached(df[column])
+        return df
+
+class TypedCache:
+    """
+    Stores the typed data frame in a columnar Arrow (Feather) file, so it does not have to be re-parsed from the csv file.
+
+    Parameters:
+    ----------
+    path: string
+        Location of the cache file. Defaults to "loan_payments.feather" in the current directory.
+
+    Attributes:
+    ----------
+    path: string
+        Check Parameters section.
+
+    Methods:
+    ----------
+    fingerprint_table(engine, table_name)
+        Returns a fingerprint of the content of the source table, so inserted, updated and deleted rows all invalidate the cache.
+        On PostgreSQL it is the row count and the sum of a hash of every row, computed in the database (one scan, only two numbers are transferred).
+        On a SQLite file it is the size and modification time of the file. Other databases only get the row count and highest id,
+        which does not detect rows updated in place.
+    fingerprint_file(path)
+        Returns a fingerprint of a local source file built from its size and modification time.
+    save(df, fingerprint, watermark)
+        Writes the data frame with its final dtypes (categories and datetimes) and the fingerprint of the source it came from.
+        An optional watermark dictionary (see RDSDatabaseConnector.sync_incremental) is stored in the same file, so the two never disagree.
+    load(fingerprint)
+        Returns the cached data frame, or None when there is no cache or it was built from a different version of the source.
+        Passing None as the fingerprint returns the cached data frame whatever source it was built from.
+        The file is written uncompressed and read memory-mapped, so numeric and datetime columns are not copied on load.
+    load_watermark()
+        Returns the watermark stored with the cache, or None. Only the file header is read.
+    """
+
+    # Class constructor
+    def __init__(self, path = "loan_payments.feather"):
+        self.path = path
+
+    # Methods
+    def fingerprint_table(self, engine, table_name = "loan_payments"):
+        if engine.dialect.name == "sqlite" and engine.url.database not in (None, "", ":memory:"):
+            return f"{table_name}:{self.fingerprint_file(engine.url.database)}"
+        if engine.dialect.name == "postgresql":
+            # The first 60 bits of the md5 of each row, summed, so the result does not depend on row order.
+            query = f"SELECT COUNT(*), SUM(('x' || LEFT(MD5(t::text), 15))::bit(60)::bigint) FROM {table_name} AS t"
+        else:
+            query = f"SELECT COUNT(*), MAX(id) FROM {table_name}"
+        with engine.connect() as connection:
+            row = connection.execute(text(query)).one()
+        return f"{table_name}:{row[0]}:{row[1]}"
+    def fingerprint_file(self, path):
+        stat = os.stat(path)
+        return f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def save(self, df, fingerprint, watermark = None):
+        table = pa.Table.from_pandas(df)
+        metadata = {**(table.schema.metadata or {}), b"fingerprint": fingerprint.encode()}
+        if watermark is not None:
+            metadata[b"watermark"] = json.dumps(watermark).encode()
+        table = table.replace_schema_metadata(metadata)
+        # Write to a temporary file first so a reader never sees a half-written cache.
+        feather.write_feather(table, self.path + ".tmp", compression = "uncompressed")
+        os.replace(self.path + ".tmp", self.path)
+
+    def load(self, fingerprint):
+        if not os.path.exists(self.path):
+            return None
+        with pa.memory_map(self.path) as source:
+            reader = pa.ipc.open_file(source)
+            if fingerprint is not None and (reader.schema.metadata or {}).get(b"fingerprint") != fingerprint.encode():
+                return None
+            return reader.read_all().to_pandas(split_blocks = True)
+
+    def load_watermark(self):
+        if not os.path.exists(self.path):
+            return None
+        with pa.memory_map(self.path) as source:
+            watermark = (pa.ipc.open_file(source).schema.metadata or {}).get(b"watermark")
+        return json.loads(watermark) if watermark else None
\ No newline at end of file
@@ -1,3 +1,22 @@
+def peak_rss_mb():
+    # Peak resident set size of this process in MB, or None where the resource module is unavailable (Windows).
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def bounded_map(executor, function, items, window):
+    # Like executor.map, but only keeps window calls in flight: the next item is taken from items when a result is consumed,
+    # so a lazy iterable (a chunked read) is never pulled into memory all at once. Results are yielded in the order of items.
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) == window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
 class RDSDatabaseConnector:
     """
     Extracts the remote database to a csv on the local machine.
@@ -14,27 +33,58 @@ class RDSDatabaseConnector:
         Check Parameters section.
     engine: engine
         Database obtained from the SQLAlchemy method below.
+    engines: dictionary
+        Engines already created by the SQLAlchemy method, keyed by database URL and pool size, so their connection pools are reused.
     loan_payments: pd.DataFrame
         Pandas dataframe obtained from the extract_data method below.
 
     Methods:
     ----------
-    SQLAlchemy(cred)
-        Imports the RDS database using the credentials. Returns "engine".
+    SQLAlchemy(cred, pool_size)
+        Imports the RDS database using the credentials (self.cred when cred is not given). Returns "engine".
+        The engine keeps a pool of pool_size connections and is reused by later calls with the same credentials.
     extract_data(engine)
          Converts the database to a pandas data frame. Returns the data frame "loan_payments".
     save_csv(loan_payments)
         Saves the previously obtained data frame to the current directory as a csv file.
+    extract_data_chunked(engine, path, table_name, chunksize)
+        Streams the table through a server-side cursor in fixed-size chunks, appending each chunk to the csv file as it arrives.
+        Only one chunk is held in memory at a time, so peak memory stays flat however large the table is.
+        Returns a report with the row count, elapsed seconds, rows per second and the RSS growth in MB: how far the call raised the process
+        peak RSS, which stays near the size of one chunk. It is 0 when an earlier call (e.g. extract_data) had already raised the peak higher.
+    save_cache(loan_payments, fingerprint, cache)
+        Successor to save_csv. Converts the data types with DataTransform and stores the typed data frame in a TypedCache.
+    extract_data_cached(engine, cache)
+        Returns the typed data frame from the cache, only extracting and saving the table again when its fingerprint has changed.
+    sync_incremental(engine, cache, table_name, key, updated_column)
+        Brings the cache up to date by fetching only the rows which are new (key above the stored watermark) or updated
+        (updated_column at or after the stored watermark), and upserting them into the cached data frame by key.
+        The first run, or a run without a watermark, extracts the whole table. Returns a report of the rows fetched, inserted, updated
+        (fetched rows whose values changed) and unchanged (rows fetched again because they were updated on the watermark date itself).
+        updated_column can be a date or timestamp column, or a text column of day/month/year dates (as in loan_payments), which is compared
+        as a year-month-day string built in SQL, so the comparison follows the calendar and not the text.
+    watermark_expression(column)
+        Returns the SQL expression the updated_column watermark is compared on (see sync_incremental).
+    extract_data_partitioned(engine, partitions, workers, retries, path, table_name, key)
+        Splits the table into key ranges and fetches them concurrently over the engine's connection pool, retrying failed partitions.
+        The partitions are assembled in key order into one data frame, or appended to the csv file at path as they arrive (returning None).
+        Returns the data frame and a report with the key range, rows, seconds and attempts of every partition.
     """
 
     # Class constructor
     def __init__(self, cred):
         self.cred = cred
+        self.engine = None
+        self.engines = {}
         
     # Methods
-    def SQLAlchemy(self, cred):
-        engine = create_engine(f"postgresql+psycopg2://{self.cred['RDS_USER']}:{self.cred['RDS_PASSWORD']}@{self.cred['RDS_HOST']}:{self.cred['RDS_PORT']}/{self.cred['RDS_DATABASE']}")
-        return engine
+    def SQLAlchemy(self, cred = None, pool_size = 5):
+        cred = cred or self.cred
+        url = f"postgresql+psycopg2://{cred['RDS_USER']}:{cred['RDS_PASSWORD']}@{cred['RDS_HOST']}:{cred['RDS_PORT']}/{cred['RDS_DATABASE']}"
+        if (url, pool_size) not in self.engines:
+            self.engines[(url, pool_size)] = create_engine(url, pool_size = pool_size, max_overflow = 0, pool_pre_ping = True)
+        self.engine = self.engines[(url, pool_size)]
+        return self.engine
     
     def extract_data(self, engine):
         sql_query = pd.read_sql_table("loan_payments", engine)
@@ -42,4 +92,139 @@ class RDSDatabaseConnector:
         return loan_payments
 
     def save_csv(self, loan_payments):
-        return loan_payments.to_csv("loan_payments.csv")
\ No newline at end of file
+        return loan_payments.to_csv("loan_payments.csv")
+
+    def extract_data_chunked(self, engine, path = "loan_payments.csv", table_name = "loan_payments", chunksize = 50000):
+        # The peak RSS is a high-water mark of the whole process, so the report gives its growth during this call.
+        rss_before = peak_rss_mb()
+        start = time.perf_counter()
+        rows = 0
+        # stream_results asks the driver for a server-side cursor (named cursor on psycopg2), so rows are fetched chunk by chunk.
+        with engine.connect().execution_options(stream_results = True, max_row_buffer = chunksize) as connection, open(path, "w", newline = "") as csv_file:
+            for chunk in pd.read_sql_table(table_name, connection, chunksize = chunksize):
+                # Continue the index across chunks so the file matches the one written by save_csv.
+                chunk.index = pd.RangeIndex(rows, rows + len(chunk))
+                chunk.to_csv(csv_file, header = rows == 0)
+                rows += len(chunk)
+        seconds = time.perf_counter() - start
+        rss_growth = None if rss_before is None else peak_rss_mb() - rss_before
+        return {"rows": rows, "seconds": seconds, "rows_per_second": rows / seconds if seconds else None, "rss_growth_mb": rss_growth}
+
+    def save_cache(self, loan_payments, fingerprint, cache = None):
+        cache = cache or TypedCache()
+        transform = DataTransform(loan_payments)
+        loan_payments = transform.change_data_type_datetime(transform.change_data_type_category(loan_payments))
+        cache.save(loan_payments, fingerprint)
+        return loan_payments
+
+    def extract_data_cached(self, engine, cache = None):
+        cache = cache or TypedCache()
+        fingerprint = cache.fingerprint_table(engine)
+        loan_payments = cache.load(fingerprint)
+        if loan_payments is None:
+            loan_payments = self.save_cache(self.extract_data(engine), fingerprint, cache)
+        return loan_payments
+
+    def watermark_expression(self, column):
+        if isinstance(column.type, String):
+            # dd/mm/yyyy text sorts by day first; rebuild it as yyyy-mm-dd, which sorts like the date.
+            return func.substr(column, 7, 4) + "-" + func.substr(column, 4, 2) + "-" + func.substr(column, 1, 2)
+        return column
+
+    def sync_incremental(self, engine, cache = None, table_name = "loan_payments", key = "id", updated_column = "last_credit_pull_date"):
+        start = time.perf_counter()
+        cache = cache or TypedCache()
+        table = Table(table_name, MetaData(), autoload_with = engine)
+        updated = self.watermark_expression(table.c[updated_column])
+        watermark = cache.load_watermark()
+        cached = cache.load(None) if watermark else None
+        with engine.connect() as connection:
+            # Read the new watermark and fingerprint before the delta, so rows written while syncing are fetched again next run rather than missed.
+            new_key, new_updated = connection.execute(select(func.max(table.c[key]), func.max(updated))).one()
+            fingerprint = cache.fingerprint_table(engine, table_name)
+            if cached is None:
+                delta = pd.read_sql_query(select(table), connection)
+            else:
+                old_updated = watermark[updated_column]
+                python_type = table.c[updated_column].type.python_type
+                if old_updated is not None and hasattr(python_type, "fromisoformat"):
+                    old_updated = python_type.fromisoformat(old_updated)
+                condition = table.c[key] > watermark[key]
+                if old_updated is not None:
+                    condition = or_(condition, updated >= old_updated)
+                delta = pd.read_sql_query(select(table).where(condition), connection)
+        transform = DataTransform(delta)
+        delta = transform.change_data_type_datetime(transform.change_data_type_category(delta))
+        if cached is None:
+            inserted, changed, merged = len(delta), 0, delta
+        else:
+            existing = cached[key].isin(delta[key])
+            inserted = len(delta) - int(existing.sum())
+            # Rows fetched again without any change (same values as in the cache) are not counted as updated.
+            columns = [column for column in delta.columns if column in cached.columns]
+            for column in columns:
+                # A small delta can have a column of only NULLs, which is read as object; give it the cached dtype so the values compare equal.
+                if delta[column].dtype != cached[column].dtype and not isinstance(cached[column].dtype, pd.CategoricalDtype):
+                    try:
+                        delta[column] = delta[column].astype(cached[column].dtype)
+                    except (TypeError, ValueError):
+                        pass
+            old_hashes = pd.Series(pd.util.hash_pandas_object(cached.loc[existing, columns], index = False).to_numpy(), index = cached.loc[existing, key])
+            new_hashes = pd.util.hash_pandas_object(delta[columns], index = False).to_numpy()
+            changed = int((delta[key].map(old_hashes).to_numpy() != new_hashes)[delta[key].isin(cached[key]).to_numpy()].sum())
+            merged = pd.concat([cached[~existing], delta], ignore_index = True).sort_values(key, ignore_index = True)
+            # Categories of the delta can differ from the cached ones, in which case concat falls back to plain strings.
+            merged = DataTransform(merged).change_data_type_category(merged)
+        new_watermark = {key: new_key, updated_column: new_updated.isoformat() if hasattr(new_updated, "isoformat") else new_updated}
+        cache.save(merged, fingerprint, new_watermark)
+        return {"mode": "full" if cached is None else "incremental", "rows_fetched": len(delta), "rows_inserted": inserted,
+                "rows_updated": changed, "rows_unchanged": len(delta) - inserted - changed, "rows_total": len(merged),
+                "seconds": time.perf_counter() - start}
+
+    def extract_data_partitioned(self, engine, partitions = 8, workers = 4, retries = 2, path = None, table_name = "loan_payments", key = "id"):
+        table = Table(table_name, MetaData(), autoload_with = engine)
+        with engine.connect() as connection:
+            low, high = connection.execute(select(func.min(table.c[key]), func.max(table.c[key]))).one()
+        if low is None:
+            # No key range to split (an empty table): it is read in one query and, like the partitions, written to path when one is given.
+            loan_payments = pd.read_sql_table(table_name, engine)
+            if path:
+                loan_payments.to_csv(path)
+                return None, []
+            return loan_payments, []
+        bounds = np.unique(np.linspace(low, high + 1, partitions + 1).astype(np.int64))
+        ranges = list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+        # More workers than pooled connections would only queue on the pool.
+        if hasattr(engine.pool, "size"):
+            workers = min(workers, engine.pool.size())
+
+        def fetch(partition, lower, upper):
+            for attempt in range(1, retries + 2):
+                start = time.perf_counter()
+                try:
+                    with engine.connect() as connection:
+                        chunk = pd.read_sql_query(select(table).where(table.c[key] >= lower, table.c[key] < upper).order_by(table.c[key]), connection)
+                except SQLAlchemyError:
+                    if attempt > retries:
+                        raise
+                    time.sleep(0.5 * 2 ** (attempt - 1))
+                    continue
+                return chunk, {"partition": partition, "lower": lower, "upper": upper, "rows": len(chunk), "seconds": time.perf_counter() - start, "attempts": attempt}
+
+        report = []
+        frames = []
+        with ThreadPoolExecutor(max_workers = workers) as executor, (open(path, "w", newline = "") if path else nullcontext()) as csv_file:
+            # Partitions are collected in key order and only a window of them is in flight,
+            # so when streaming to a file at most 2 * workers partitions are held in memory.
+            rows = 0
+            partitions = [(number, lower, upper) for number, (lower, upper) in enumerate(ranges)]
+            for chunk, timing in bounded_map(executor, lambda partition: fetch(*partition), partitions, 2 * workers):
+                report.append(timing)
+                if path:
+                    chunk.index = pd.RangeIndex(rows, rows + len(chunk))
+                    chunk.to_csv(csv_file, header = rows == 0)
+                else:
+                    frames.append(chunk)
+                rows += len(chunk)
+        loan_payments = None if path else pd.concat(frames, ignore_index = True)
+        return loan_payments, report
\ No newline at end of file
@@ -0,0 +1,295 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+from db_utils import (RDSDatabaseConnector, DataTransform, DataFrameTransform, LossAnalytics, csv_to_df, peak_rss_mb)
+
+# Share of NULL values in each column of loan_payments. The four sparse columns are the counts seen in the 54231-row extract.
+NULL_RATES = {
+    "funded_amount": 0.0554,
+    "term": 0.088,
+    "int_rate": 0.0953,
+    "employment_length": 0.0391,
+    "mths_since_last_delinq": 31002 / 54231,
+    "mths_since_last_record": 48050 / 54231,
+    "last_payment_date": 0.0013,
+    "next_payment_date": 32608 / 54231,
+    "last_credit_pull_date": 0.0001,
+    "collections_12_mths_ex_med": 0.0009,
+    "mths_since_last_major_derog": 46732 / 54231,
+}
+
+LOAN_STATUSES = {
+    "Fully Paid": 0.50,
+    "Current": 0.355,
+    "Charged Off": 0.103,
+    "Does not meet the credit policy. Status:Fully Paid": 0.0185,
+    "Does not meet the credit policy. Status:Charged Off": 0.0045,
+    "Late (31-120 days)": 0.012,
+    "In Grace Period": 0.0002,
+    "Late (16-30 days)": 0.0068,
+}
+
+PURPOSES = {
+    "debt_consolidation": 0.55, "credit_card": 0.2, "home_improvement": 0.06, "other": 0.06, "major_purchase": 0.03, "small_business": 0.02,
+    "car": 0.02, "medical": 0.015, "moving": 0.01, "vacation": 0.008, "wedding": 0.007, "house": 0.006, "educational": 0.002, "renewable_energy": 0.002,
+}
+
+EMPLOYMENT_LENGTHS = ["< 1 year", "1 year", "2 years", "3 years", "4 years", "5 years", "6 years", "7 years", "8 years", "9 years", "10+ years"]
+
+def choice(rng, options, rows):
+    # Draws rows values from a dictionary of option: probability.
+    probabilities = np.array(list(options.values()))
+    return np.array(list(options))[rng.choice(len(options), rows, p = probabilities / probabilities.sum())]
+
+def loan_payments_frame(rows, seed = 0, start = 0):
+    """
+    Returns rows synthetic loans with the columns, dtypes, NULL rates and skewed distributions of the loan_payments table.
+    Loans are reproducible: the same seed and start always give the same rows, so a large table can be generated in chunks.
+    Dates are day/month/year strings, as in loan_payments.csv.
+    """
+    rng = np.random.default_rng([seed, start])
+    months = pd.date_range("2007-01-01", "2022-12-01", freq = "MS")
+    month_names = months.strftime("%d/%m/%Y").to_numpy()
+    df = {}
+    df["id"] = np.arange(start, start + rows) * 3 + 38676
+    df["member_id"] = df["id"] + rng.integers(1, 200000, rows)
+    loan_amount = np.clip(np.round(rng.lognormal(9.2, 0.65, rows) / 25) * 25, 500, 35000)
+    df["loan_amount"] = loan_amount
+    df["funded_amount"] = np.where(rng.random(rows) < 0.03, np.round(loan_amount * rng.uniform(0.5, 1, rows), -2), loan_amount)
+    df["funded_amount_inv"] = np.round(df["funded_amount"] * np.where(rng.random(rows) < 0.8, 1, rng.uniform(0.6, 1, rows)), 2)
+    term = np.where(rng.random(rows) < 0.72, 36, 60)
+    df["term"] = np.where(term == 36, "36 months", "60 months")
+    grade = rng.choice(7, rows, p = [0.19, 0.3, 0.23, 0.15, 0.08, 0.04, 0.01])
+    int_rate = np.round(np.clip(6 + grade * 3.2 + rng.normal(0, 1.2, rows), 5.3, 26), 2)
+    df["int_rate"] = int_rate
+    monthly_rate = int_rate / 1200
+    df["instalment"] = np.round(loan_amount * monthly_rate / (1 - (1 + monthly_rate) ** -term), 2)
+    df["grade"] = np.array(list("ABCDEFG"))[grade]
+    df["sub_grade"] = np.char.add(df["grade"], rng.integers(1, 6, rows).astype(str))
+    df["employment_length"] = np.array(EMPLOYMENT_LENGTHS)[rng.choice(11, rows, p = [0.09] + [0.075] * 9 + [0.235])]
+    df["home_ownership"] = choice(rng, {"MORTGAGE": 0.49, "RENT": 0.41, "OWN": 0.095, "OTHER": 0.005}, rows)
+    df["annual_inc"] = np.round(rng.lognormal(11.05, 0.55, rows), -2)
+    df["verification_status"] = choice(rng, {"Verified": 0.39, "Source Verified": 0.33, "Not Verified": 0.28}, rows)
+    # Months since January 2007 when the loan was issued, and how many monthly payments have been made since.
+    issued = rng.integers(0, len(months) - 12, rows)
+    loan_status = choice(rng, LOAN_STATUSES, rows)
+    df["issue_date"] = month_names[issued]
+    df["loan_status"] = loan_status
+    df["payment_plan"] = np.where(rng.random(rows) < 0.9995, "n", "y")
+    df["purpose"] = choice(rng, PURPOSES, rows)
+    df["dti"] = np.round(rng.gamma(4, 4, rows).clip(0, 40), 2)
+    df["delinq_2yrs"] = rng.negative_binomial(1, 0.82, rows)
+    df["earliest_credit_line"] = month_names[np.maximum(issued - rng.integers(24, 240, rows), 0)]
+    df["inq_last_6mths"] = rng.negative_binomial(1, 0.55, rows)
+    df["mths_since_last_delinq"] = rng.integers(0, 150, rows).astype(np.float64)
+    df["mths_since_last_record"] = rng.integers(0, 130, rows).astype(np.float64)
+    df["open_accounts"] = rng.poisson(10, rows) + 1
+    df["total_accounts"] = df["open_accounts"] + rng.poisson(14, rows)
+    paid_off = np.isin(loan_status, ["Fully Paid", "Does not meet the credit policy. Status:Fully Paid"])
+    charged_off = np.isin(loan_status, ["Charged Off", "Does not meet the credit policy. Status:Charged Off"])
+    months_paid = np.where(paid_off, rng.integers(6, term + 1), np.where(charged_off, rng.integers(1, term // 2), rng.integers(1, term)))
+    months_paid = np.minimum(months_paid, len(months) - 1 - issued)
+    outstanding = np.where(paid_off | charged_off, 0.0, np.round(loan_amount * (1 - months_paid / term) * rng.uniform(0.9, 1, rows), 2))
+    df["out_prncp"] = outstanding
+    df["out_prncp_inv"] = np.round(outstanding * df["funded_amount_inv"] / df["funded_amount"], 2)
+    total_payment = np.round(np.where(paid_off, df["instalment"] * term * rng.uniform(0.8, 1, rows), df["instalment"] * months_paid), 2)
+    df["total_payment"] = total_payment
+    df["total_payment_inv"] = np.round(total_payment * df["funded_amount_inv"] / df["funded_amount"], 2)
+    total_rec_int = np.round(total_payment * np.clip(int_rate / 100 * term / 24, 0.02, 0.6), 2)
+    df["total_rec_prncp"] = np.round(total_payment - total_rec_int, 2)
+    df["total_rec_int"] = total_rec_int
+    df["total_rec_late_fee"] = np.where(rng.random(rows) < 0.95, 0.0, np.round(rng.exponential(15, rows), 2))
+    recoveries = np.where(charged_off & (rng.random(rows) < 0.7), np.round(rng.lognormal(6.5, 1.2, rows), 2), 0.0)
+    df["recoveries"] = recoveries
+    df["collection_recovery_fee"] = np.round(np.where(rng.random(rows) < 0.5, recoveries * rng.uniform(0, 0.2, rows), 0.0), 2)
+    last_payment = np.minimum(issued + months_paid, len(months) - 1)
+    df["last_payment_date"] = month_names[last_payment]
+    df["last_payment_amount"] = np.round(np.where(paid_off, rng.lognormal(7, 1.5, rows), df["instalment"] * rng.uniform(0.9, 1.1, rows)), 2)
+    df["next_payment_date"] = month_names[np.minimum(last_payment + 1, len(months) - 1)]
+    df["last_credit_pull_date"] = month_names[np.minimum(last_payment + rng.integers(0, 24, rows), len(months) - 1)]
+    df["collections_12_mths_ex_med"] = np.where(rng.random(rows) < 0.995, 0.0, 1.0)
+    df["mths_since_last_major_derog"] = rng.integers(0, 150, rows).astype(np.float64)
+    df["policy_code"] = np.ones(rows, dtype = np.int64)
+    df["application_type"] = np.full(rows, "INDIVIDUAL")
+    df = pd.DataFrame(df, index = pd.RangeIndex(start, start + rows))
+    for column, rate in NULL_RATES.items():
+        df[column] = df[column].mask(rng.random(rows) < rate)
+    return df
+
+# Tables are generated in chunks of this many rows, so the csv file and the database get the same data for a given seed.
+CHUNK_ROWS = 100_000
+
+def loan_payments_chunks(rows, seed = 0):
+    for start in range(0, rows, CHUNK_ROWS):
+        yield loan_payments_frame(min(CHUNK_ROWS, rows - start), seed, start)
+
+def write_csv(rows, path = "loan_payments.csv", seed = 0):
+    # Writes the synthetic table in the same layout as RDSDatabaseConnector.save_csv (the index is the first, unnamed column).
+    with open(path, "w", newline = "") as csv_file:
+        for chunk in loan_payments_chunks(rows, seed):
+            chunk.to_csv(csv_file, header = chunk.index[0] == 0)
+    return path
+
+def load_database(engine, rows, table_name = "loan_payments", seed = 0):
+    # Loads the synthetic table into a local stand-in of the RDS database, e.g. create_engine("sqlite:///loans.db")
+    # or a local Postgres server, so the extraction methods of RDSDatabaseConnector can be benchmarked.
+    for chunk in loan_payments_chunks(rows, seed):
+        chunk.to_sql(table_name, engine, if_exists = "replace" if chunk.index[0] == 0 else "append", index = False, chunksize = 10_000)
+    return engine
+
+def skew_frame(rows, seed = 0):
+    # Non-negative, right-skewed columns like the ones reduce_skew transforms.
+    rng = np.random.default_rng(seed)
+    columns = DataFrameTransform.LOG_COLUMNS + DataFrameTransform.SQRT_COLUMNS
+    return pd.DataFrame({column: rng.lognormal(8, 1.5, rows) for column in columns})
+
+def measure(function, *args, trace = True, **kwargs):
+    # Returns the result, the seconds taken and the peak memory allocated (in MB, None when trace is False) while running function.
+    # tracemalloc slows down code which allocates many Python objects (reading sql or csv), so timings should be taken without it.
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2 if trace else None
+    if trace:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+def version():
+    # The commit being benchmarked (of the repository this file is in, wherever it is run from), so results of different versions can be told apart.
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output = True, text = True, check = True,
+                              cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def benchmark_reduce_skew(rows_list, workers, seed = 0):
+    # Compares reduce_skew as it was (column by column with temporaries) with the in-place, threaded mode in float64 and float32.
+    results = []
+    for rows in rows_list:
+        for mode, options in [("serial", {}), ("in-place", {"workers": workers}), ("in-place float32", {"workers": workers, "float32": True})]:
+            df = skew_frame(rows, seed)
+            _, seconds, peak = measure(DataFrameTransform(df).reduce_skew, df, **options)
+            results.append({"stage": "reduce_skew", "rows": rows, "mode": mode, "seconds": round(seconds, 3), "peak_mb": round(peak, 1)})
+            del df
+    return pd.DataFrame(results)
+
+def run_stages(rows, engine, path, trace):
+    # Runs the stages once, each on the output of the previous one, and returns one result per stage.
+    results = []
+    def stage(name, function, *args):
+        # The process peak RSS only ever grows, so each stage records how far it raised it (0 when it stayed under an earlier peak).
+        rss_before = peak_rss_mb()
+        result, seconds, peak = measure(function, *args, trace = trace)
+        rss_growth = None if rss_before is None else round(peak_rss_mb() - rss_before, 1)
+        results.append({"stage": name, "rows": rows, "mode": "traced" if trace else "timed", "seconds": round(seconds, 3),
+                        "peak_mb": None if peak is None else round(peak, 1), "rss_growth_mb": rss_growth})
+        return result
+    stage("extraction", RDSDatabaseConnector(None).extract_data_chunked, engine, path)
+    df = stage("csv_to_df", csv_to_df, path)
+    transform = DataTransform(df)
+    df = stage("DataTransform", lambda frame: transform.change_data_type_datetime(transform.change_data_type_category(frame)), df)
+    df = df.drop(["mths_since_last_delinq", "mths_since_last_record", "next_payment_date", "mths_since_last_major_derog"], axis = 1)
+    df = stage("impute_missing", DataFrameTransform(df).impute_missing, df)
+    df = stage("reduce_skew", DataFrameTransform(df).reduce_skew, df)
+    df = stage("remove_outliers", DataFrameTransform(df).remove_outliers, df)
+    stage("correlation", DataFrameTransform(df).correlated_columns, df)
+    stage("milestone_analytics", lambda frame: [LossAnalytics(frame).summary(by) for by in [None, "grade", "purpose", "term"]], df)
+    return results
+
+def benchmark_stages(rows_list, data_dir = "benchmark_data", database = None, seed = 0, trace = True):
+    """
+    Runs every stage of the analysis on synthetic data of each size, each stage on the output of the previous one:
+    extraction (from database, a SQLAlchemy URL, or a SQLite file in data_dir), csv_to_df, DataTransform, impute_missing, reduce_skew,
+    remove_outliers, correlation (DataFrameTransform.correlated_columns) and the milestone analytics (LossAnalytics).
+    The stages are run once untraced ("timed" mode: seconds and how much the stage raised the process peak RSS) and, if trace is True,
+    once more under tracemalloc ("traced" mode: peak allocation of each stage).
+    """
+    os.makedirs(data_dir, exist_ok = True)
+    results = []
+    for rows in rows_list:
+        engine = create_engine(database or f"sqlite:///{os.path.join(data_dir, f'loan_payments_{rows}.db')}")
+        load_database(engine, rows, seed = seed)
+        path = os.path.join(data_dir, f"loan_payments_{rows}.csv")
+        for traced in ([False, True] if trace else [False]):
+            results += run_stages(rows, engine, path, traced)
+        engine.dispose()
+    return pd.DataFrame(results)
+
+def save_results(results, path = "benchmark_results.jsonl"):
+    # Appends one JSON line per result, tagged with the version and environment, so runs of different versions can be compared.
+    details = {"version": version(), "timestamp": datetime.datetime.now().isoformat(timespec = "seconds"),
+               "python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__}
+    # Missing values (peak_mb in timed mode, for example) are written as null, as NaN is not valid JSON.
+    results = results.astype(object).where(results.notna(), None)
+    with open(path, "a") as results_file:
+        for row in results.to_dict("records"):
+            results_file.write(json.dumps({**details, **row}, allow_nan = False) + "\n")
+    return path
+
+def compare(baseline, current, path = "benchmark_results.jsonl", tolerance = 0.1):
+    # Compares the latest results of two versions for each stage, size and mode. Slower or larger by more than tolerance is a regression.
+    # Memory is the tracemalloc peak (peak_mb, traced mode) and the growth of the process peak RSS (rss_growth_mb, timed mode).
+    # RSS growths below 1 MB are counted as 1 MB, so a stage going from 0 to a few kB of growth is not reported.
+    results = pd.read_json(path, lines = True)
+    results["version"] = results["version"].astype(str)
+    latest = results.sort_values("timestamp").groupby(["version", "stage", "rows", "mode"]).last()
+    if baseline not in latest.index or current not in latest.index:
+        raise ValueError(f"No results for version {baseline if baseline not in latest.index else current} in {path}")
+    # Results saved before rss_growth_mb was recorded do not have the column.
+    latest = latest.reindex(columns = ["seconds", "peak_mb", "rss_growth_mb"])
+    table = latest.loc[baseline].join(latest.loc[current], lsuffix = "_baseline", rsuffix = "_current", how = "inner")
+    table["time_ratio"] = table["seconds_current"] / table["seconds_baseline"]
+    table["memory_ratio"] = table["peak_mb_current"] / table["peak_mb_baseline"]
+    table["rss_growth_ratio"] = table["rss_growth_mb_current"].clip(lower = 1) / table["rss_growth_mb_baseline"].clip(lower = 1)
+    table["regression"] = (table["time_ratio"] > 1 + tolerance) | (table["memory_ratio"] > 1 + tolerance) | (table["rss_growth_ratio"] > 1 + tolerance)
+    return table.reset_index()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmarks the stages of db_utils.py on synthetic loan_payments data.")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    stages = commands.add_parser("stages", help = "time and memory-profile every stage of the analysis")
+    stages.add_argument("--rows", type = int, nargs = "+", default = [50_000, 1_000_000, 10_000_000, 50_000_000])
+    stages.add_argument("--database", help = "SQLAlchemy URL of the stand-in database, for example postgresql://localhost/loans (a SQLite file by default)")
+    stages.add_argument("--data-dir", default = "benchmark_data")
+    stages.add_argument("--no-trace", action = "store_true", help = "skip the second, memory-traced run of the stages")
+    skew = commands.add_parser("reduce_skew", help = "compare the serial and in-place, multi-threaded reduce_skew")
+    skew.add_argument("--rows", type = int, nargs = "+", default = [1_000_000, 10_000_000, 50_000_000])
+    skew.add_argument("--workers", type = int, default = 8)
+    for command in (stages, skew):
+        command.add_argument("--seed", type = int, default = 0)
+        command.add_argument("--results", default = "benchmark_results.jsonl")
+    generate = commands.add_parser("generate", help = "write synthetic loan_payments data to a csv file and/or a database")
+    generate.add_argument("--rows", type = int, default = 54231)
+    generate.add_argument("--seed", type = int, default = 0)
+    generate.add_argument("--csv")
+    generate.add_argument("--database")
+    regressions = commands.add_parser("compare", help = "compare the stored results of two versions")
+    regressions.add_argument("baseline")
+    regressions.add_argument("current")
+    regressions.add_argument("--results", default = "benchmark_results.jsonl")
+    regressions.add_argument("--tolerance", type = float, default = 0.1)
+    arguments = parser.parse_args()
+    if arguments.command == "generate":
+        if arguments.csv:
+            write_csv(arguments.rows, arguments.csv, arguments.seed)
+        if arguments.database:
+            load_database(create_engine(arguments.database), arguments.rows, seed = arguments.seed)
+    elif arguments.command == "compare":
+        print(compare(arguments.baseline, arguments.current, arguments.results, arguments.tolerance).to_string(index = False))
+    else:
+        if arguments.command == "stages":
+            results = benchmark_stages(arguments.rows, arguments.data_dir, arguments.database, arguments.seed, not arguments.no_trace)
+        else:
+            results = benchmark_reduce_skew(arguments.rows, arguments.workers, arguments.seed)
+        save_results(results, arguments.results)
+        print(results.to_string(index = False))
@@ -1,9 +1,33 @@
+import sys
 import yaml
 import psycopg2
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text, MetaData, Table, String, select, func, or_, and_, false
+from sqlalchemy.exc import SQLAlchemyError
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import numpy as np
+import time
+import math
+import operator
+import os
+import json
+import hashlib
+import weakref
+import functools
+import threading
+import tracemalloc
+import warnings
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import pyarrow as pa
+import pyarrow.feather as feather
+try:
+    import resource
+except ImportError:
+    resource = None
 
 def credentials():
     with open("credentials.yaml", "r") as stream:
@@ -13,6 +37,25 @@ def credentials():
         except yaml.YAMLError:
             print(yaml.YAMLError)
 
+def peak_rss_mb():
+    # Peak resident set size of this process in MB, or None where the resource module is unavailable (Windows).
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def bounded_map(executor, function, items, window):
+    # Like executor.map, but only keeps window calls in flight: the next item is taken from items when a result is consumed,
+    # so a lazy iterable (a chunked read) is never pulled into memory all at once. Results are yielded in the order of items.
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) == window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
 class RDSDatabaseConnector:
     """
     Extracts the remote database to a csv on the local machine.
@@ -29,27 +72,58 @@ class RDSDatabaseConnector:
         Check Parameters section.
     engine: engine
         Database obtained from the SQLAlchemy method below.
+    engines: dictionary
+        Engines already created by the SQLAlchemy method, keyed by database URL and pool size, so their connection pools are reused.
     loan_payments: pd.DataFrame
         Pandas dataframe obtained from the extract_data method below.
 
     Methods:
     ----------
-    SQLAlchemy(cred)
-        Imports the RDS database using the credentials. Returns "engine".
+    SQLAlchemy(cred, pool_size)
+        Imports the RDS database using the credentials (self.cred when cred is not given). Returns "engine".
+        The engine keeps a pool of pool_size connections and is reused by later calls with the same credentials.
     extract_data(engine)
          Converts the database to a pandas data frame. Returns the data frame "loan_payments".
     save_csv(loan_payments)
         Saves the previously obtained data frame to the current directory as a csv file.
+    extract_data_chunked(engine, path, table_name, chunksize)
+        Streams the table through a server-side cursor in fixed-size chunks, appending each chunk to the csv file as it arrives.
+        Only one chunk is held in memory at a time, so peak memory stays flat however large the table is.
+        Returns a report with the row count, elapsed seconds, rows per second and the RSS growth in MB: how far the call raised the process
+        peak RSS, which stays near the size of one chunk. It is 0 when an earlier call (e.g. extract_data) had already raised the peak higher.
+    save_cache(loan_payments, fingerprint, cache)
+        Successor to save_csv. Converts the data types with DataTransform and stores the typed data frame in a TypedCache.
+    extract_data_cached(engine, cache)
+        Returns the typed data frame from the cache, only extracting and saving the table again when its fingerprint has changed.
+    sync_incremental(engine, cache, table_name, key, updated_column)
+        Brings the cache up to date by fetching only the rows which are new (key above the stored watermark) or updated
+        (updated_column at or after the stored watermark), and upserting them into the cached data frame by key.
+        The first run, or a run without a watermark, extracts the whole table. Returns a report of the rows fetched, inserted, updated
+        (fetched rows whose values changed) and unchanged (rows fetched again because they were updated on the watermark date itself).
+        updated_column can be a date or timestamp column, or a text column of day/month/year dates (as in loan_payments), which is compared
+        as a year-month-day string built in SQL, so the comparison follows the calendar and not the text.
+    watermark_expression(column)
+        Returns the SQL expression the updated_column watermark is compared on (see sync_incremental).
+    extract_data_partitioned(engine, partitions, workers, retries, path, table_name, key)
+        Splits the table into key ranges and fetches them concurrently over the engine's connection pool, retrying failed partitions.
+        The partitions are assembled in key order into one data frame, or appended to the csv file at path as they arrive (returning None).
+        Returns the data frame and a report with the key range, rows, seconds and attempts of every partition.
     """
 
     # Class constructor
     def __init__(self, cred):
         self.cred = cred
+        self.engine = None
+        self.engines = {}
         
     # Methods
-    def SQLAlchemy(self, cred):
-        engine = create_engine(f"postgresql+psycopg2://{self.cred["RDS_USER"]}:{self.cred["RDS_PASSWORD"]}@{self.cred["RDS_HOST"]}:{self.cred["RDS_PORT"]}/{self.cred["RDS_DATABASE"]}")
-        return engine
+    def SQLAlchemy(self, cred = None, pool_size = 5):
+        cred = cred or self.cred
+        url = f"postgresql+psycopg2://{cred['RDS_USER']}:{cred['RDS_PASSWORD']}@{cred['RDS_HOST']}:{cred['RDS_PORT']}/{cred['RDS_DATABASE']}"
+        if (url, pool_size) not in self.engines:
+            self.engines[(url, pool_size)] = create_engine(url, pool_size = pool_size, max_overflow = 0, pool_pre_ping = True)
+        self.engine = self.engines[(url, pool_size)]
+        return self.engine
     
     def extract_data(self, engine):
         sql_query = pd.read_sql_table("loan_payments", engine)
@@ -59,12 +133,166 @@ class RDSDatabaseConnector:
     def save_csv(self, loan_payments):
         return loan_payments.to_csv("loan_payments.csv")
 
+    def extract_data_chunked(self, engine, path = "loan_payments.csv", table_name = "loan_payments", chunksize = 50000):
+        # The peak RSS is a high-water mark of the whole process, so the report gives its growth during this call.
+        rss_before = peak_rss_mb()
+        start = time.perf_counter()
+        rows = 0
+        # stream_results asks the driver for a server-side cursor (named cursor on psycopg2), so rows are fetched chunk by chunk.
+        with engine.connect().execution_options(stream_results = True, max_row_buffer = chunksize) as connection, open(path, "w", newline = "") as csv_file:
+            for chunk in pd.read_sql_table(table_name, connection, chunksize = chunksize):
+                # Continue the index across chunks so the file matches the one written by save_csv.
+                chunk.index = pd.RangeIndex(rows, rows + len(chunk))
+                chunk.to_csv(csv_file, header = rows == 0)
+                rows += len(chunk)
+        seconds = time.perf_counter() - start
+        rss_growth = None if rss_before is None else peak_rss_mb() - rss_before
+        return {"rows": rows, "seconds": seconds, "rows_per_second": rows / seconds if seconds else None, "rss_growth_mb": rss_growth}
+
+    def save_cache(self, loan_payments, fingerprint, cache = None):
+        cache = cache or TypedCache()
+        transform = DataTransform(loan_payments)
+        loan_payments = transform.change_data_type_datetime(transform.change_data_type_category(loan_payments))
+        cache.save(loan_payments, fingerprint)
+        return loan_payments
+
+    def extract_data_cached(self, engine, cache = None):
+        cache = cache or TypedCache()
+        fingerprint = cache.fingerprint_table(engine)
+        loan_payments = cache.load(fingerprint)
+        if loan_payments is None:
+            loan_payments = self.save_cache(self.extract_data(engine), fingerprint, cache)
+        return loan_payments
+
+    def watermark_expression(self, column):
+        if isinstance(column.type, String):
+            # dd/mm/yyyy text sorts by day first; rebuild it as yyyy-mm-dd, which sorts like the date.
+            return func.substr(column, 7, 4) + "-" + func.substr(column, 4, 2) + "-" + func.substr(column, 1, 2)
+        return column
+
+    def sync_incremental(self, engine, cache = None, table_name = "loan_payments", key = "id", updated_column = "last_credit_pull_date"):
+        start = time.perf_counter()
+        cache = cache or TypedCache()
+        table = Table(table_name, MetaData(), autoload_with = engine)
+        updated = self.watermark_expression(table.c[updated_column])
+        watermark = cache.load_watermark()
+        cached = cache.load(None) if watermark else None
+        with engine.connect() as connection:
+            # Read the new watermark and fingerprint before the delta, so rows written while syncing are fetched again next run rather than missed.
+            new_key, new_updated = connection.execute(select(func.max(table.c[key]), func.max(updated))).one()
+            fingerprint = cache.fingerprint_table(engine, table_name)
+            if cached is None:
+                delta = pd.read_sql_query(select(table), connection)
+            else:
+                old_updated = watermark[updated_column]
+                python_type = table.c[updated_column].type.python_type
+                if old_updated is not None and hasattr(python_type, "fromisoformat"):
+                    old_updated = python_type.fromisoformat(old_updated)
+                condition = table.c[key] > watermark[key]
+                if old_updated is not None:
+                    condition = or_(condition, updated >= old_updated)
+                delta = pd.read_sql_query(select(table).where(condition), connection)
+        transform = DataTransform(delta)
+        delta = transform.change_data_type_datetime(transform.change_data_type_category(delta))
+        if cached is None:
+            inserted, changed, merged = len(delta), 0, delta
+        else:
+            existing = cached[key].isin(delta[key])
+            inserted = len(delta) - int(existing.sum())
+            # Rows fetched again without any change (same values as in the cache) are not counted as updated.
+            columns = [column for column in delta.columns if column in cached.columns]
+            for column in columns:
+                # A small delta can have a column of only NULLs, which is read as object; give it the cached dtype so the values compare equal.
+                if delta[column].dtype != cached[column].dtype and not isinstance(cached[column].dtype, pd.CategoricalDtype):
+                    try:
+                        delta[column] = delta[column].astype(cached[column].dtype)
+                    except (TypeError, ValueError):
+                        pass
+            old_hashes = pd.Series(pd.util.hash_pandas_object(cached.loc[existing, columns], index = False).to_numpy(), index = cached.loc[existing, key])
+            new_hashes = pd.util.hash_pandas_object(delta[columns], index = False).to_numpy()
+            changed = int((delta[key].map(old_hashes).to_numpy() != new_hashes)[delta[key].isin(cached[key]).to_numpy()].sum())
+            merged = pd.concat([cached[~existing], delta], ignore_index = True).sort_values(key, ignore_index = True)
+            # Categories of the delta can differ from the cached ones, in which case concat falls back to plain strings.
+            merged = DataTransform(merged).change_data_type_category(merged)
+        new_watermark = {key: new_key, updated_column: new_updated.isoformat() if hasattr(new_updated, "isoformat") else new_updated}
+        cache.save(merged, fingerprint, new_watermark)
+        return {"mode": "full" if cached is None else "incremental", "rows_fetched": len(delta), "rows_inserted": inserted,
+                "rows_updated": changed, "rows_unchanged": len(delta) - inserted - changed, "rows_total": len(merged),
+                "seconds": time.perf_counter() - start}
+
+    def extract_data_partitioned(self, engine, partitions = 8, workers = 4, retries = 2, path = None, table_name = "loan_payments", key = "id"):
+        table = Table(table_name, MetaData(), autoload_with = engine)
+        with engine.connect() as connection:
+            low, high = connection.execute(select(func.min(table.c[key]), func.max(table.c[key]))).one()
+        if low is None:
+            # No key range to split (an empty table): it is read in one query and, like the partitions, written to path when one is given.
+            loan_payments = pd.read_sql_table(table_name, engine)
+            if path:
+                loan_payments.to_csv(path)
+                return None, []
+            return loan_payments, []
+        bounds = np.unique(np.linspace(low, high + 1, partitions + 1).astype(np.int64))
+        ranges = list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+        # More workers than pooled connections would only queue on the pool.
+        if hasattr(engine.pool, "size"):
+            workers = min(workers, engine.pool.size())
+
+        def fetch(partition, lower, upper):
+            for attempt in range(1, retries + 2):
+                start = time.perf_counter()
+                try:
+                    with engine.connect() as connection:
+                        chunk = pd.read_sql_query(select(table).where(table.c[key] >= lower, table.c[key] < upper).order_by(table.c[key]), connection)
+                except SQLAlchemyError:
+                    if attempt > retries:
+                        raise
+                    time.sleep(0.5 * 2 ** (attempt - 1))
+                    continue
+                return chunk, {"partition": partition, "lower": lower, "upper": upper, "rows": len(chunk), "seconds": time.perf_counter() - start, "attempts": attempt}
+
+        report = []
+        frames = []
+        with ThreadPoolExecutor(max_workers = workers) as executor, (open(path, "w", newline = "") if path else nullcontext()) as csv_file:
+            # Partitions are collected in key order and only a window of them is in flight,
+            # so when streaming to a file at most 2 * workers partitions are held in memory.
+            rows = 0
+            partitions = [(number, lower, upper) for number, (lower, upper) in enumerate(ranges)]
+            for chunk, timing in bounded_map(executor, lambda partition: fetch(*partition), partitions, 2 * workers):
+                report.append(timing)
+                if path:
+                    chunk.index = pd.RangeIndex(rows, rows + len(chunk))
+                    chunk.to_csv(csv_file, header = rows == 0)
+                else:
+                    frames.append(chunk)
+                rows += len(chunk)
+        loan_payments = None if path else pd.concat(frames, ignore_index = True)
+        return loan_payments, report
 
-def csv_to_df():
-    with open("loan_payments.csv", "r") as payments:
+
+def csv_to_df(path = "loan_payments.csv"):
+    with open(path, "r") as payments:
         payments_df = pd.read_csv(payments)
         return payments_df
 
+def csv_to_typed_df(path = "loan_payments.csv"):
+    # Applies the DataTransform schema while parsing: category and date columns are read straight into categories,
+    # so the full frame of date and label strings is never built. Dates are then parsed once per distinct string.
+    dtypes = {column: "category" for column in DataTransform.CATEGORY_COLUMNS + DataTransform.DATETIME_COLUMNS}
+    with open(path, "r") as payments:
+        payments_df = pd.read_csv(payments, dtype = dtypes)
+    for column in DataTransform.DATETIME_COLUMNS:
+        payments_df[column] = parse_dates_cached(payments_df[column])
+    return payments_df
+
+def parse_dates_cached(column, date_format = "%d/%m/%Y"):
+    # Loan dates have very few distinct values, so each distinct string is parsed once and the result is broadcast through the category codes.
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return column
+    categorical = column if isinstance(column.dtype, pd.CategoricalDtype) else column.astype("category")
+    parsed = pd.to_datetime(categorical.cat.categories, format = date_format)
+    values = parsed.take(categorical.cat.codes.to_numpy(), allow_fill = True, fill_value = pd.NaT)
+    return pd.Series(values, index = column.index, name = column.name)
+
 class DataTransform:
     """
     Transforms the data types of the columns in the dataframe.
@@ -88,25 +316,620 @@ class DataTransform:
     change_data_type_datetime(df)
         This function changes the data types of the following columns to datetime64:
         Change ISSUE_DATE, EARLIEST_CREDIT_LINE, LAST_PAYMENT_DATE, NEXT_PAYMENT_DATE, LAST_CREDIT_PULL_DATE to datetime64.
+        Each distinct date string is only parsed once (see parse_dates_cached).
+
+    Columns which already have the right data type are left as they are, so a frame loaded with csv_to_typed_df passes through unchanged.
     """
 
+    CATEGORY_COLUMNS = ["term", "grade", "sub_grade", "employment_length", "home_ownership", "verification_status", "loan_status", "payment_plan", "purpose", "application_type"]
+    DATETIME_COLUMNS = ["issue_date", "earliest_credit_line", "last_payment_date", "next_payment_date", "last_credit_pull_date"]
+
     # Class constructor
     def __init__(self, df):
         self.df = df
 
     # Methods
     def change_data_type_category(self, df):
-        for column in ["term", "grade", "sub_grade", "employment_length", "home_ownership", "verification_status", "loan_status", "payment_plan", "purpose", "application_type"]:
-            df[column] = df[column].astype("category")
+        for column in self.CATEGORY_COLUMNS:
+            if not isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype("category")
         return df
     def change_data_type_datetime(self, df):
-        for column in ["issue_date", "earliest_credit_line", "last_payment_date", "next_payment_date", "last_credit_pull_date"]:
-            df[column] = pd.to_datetime(df[column], format = "%d/%m/%Y")
+        for column in self.DATETIME_COLUMNS:
+            df[column] = parse_dates_cached(df[column])
         return df
 
-payments_df = DataTransform(csv_to_df()).change_data_type_category(csv_to_df())
-payments_df = DataTransform(payments_df).change_data_type_datetime(payments_df)
+class TypedCache:
+    """
+    Stores the typed data frame in a columnar Arrow (Feather) file, so it does not have to be re-parsed from the csv file.
+
+    Parameters:
+    ----------
+    path: string
+        Location of the cache file. Defaults to "loan_payments.feather" in the current directory.
+
+    Attributes:
+    ----------
+    path: string
+        Check Parameters section.
+
+    Methods:
+    ----------
+    fingerprint_table(engine, table_name)
+        Returns a fingerprint of the content of the source table, so inserted, updated and deleted rows all invalidate the cache.
+        On PostgreSQL it is the row count and the sum of a hash of every row, computed in the database (one scan, only two numbers are transferred).
+        On a SQLite file it is the size and modification time of the file. Other databases only get the row count and highest id,
+        which does not detect rows updated in place.
+    fingerprint_file(path)
+        Returns a fingerprint of a local source file built from its size and modification time.
+    save(df, fingerprint, watermark)
+        Writes the data frame with its final dtypes (categories and datetimes) and the fingerprint of the source it came from.
+        An optional watermark dictionary (see RDSDatabaseConnector.sync_incremental) is stored in the same file, so the two never disagree.
+    load(fingerprint)
+        Returns the cached data frame, or None when there is no cache or it was built from a different version of the source.
+        Passing None as the fingerprint returns the cached data frame whatever source it was built from.
+        The file is written uncompressed and read memory-mapped, so numeric and datetime columns are not copied on load.
+    load_watermark()
+        Returns the watermark stored with the cache, or None. Only the file header is read.
+    """
+
+    # Class constructor
+    def __init__(self, path = "loan_payments.feather"):
+        self.path = path
+
+    # Methods
+    def fingerprint_table(self, engine, table_name = "loan_payments"):
+        if engine.dialect.name == "sqlite" and engine.url.database not in (None, "", ":memory:"):
+            return f"{table_name}:{self.fingerprint_file(engine.url.database)}"
+        if engine.dialect.name == "postgresql":
+            # The first 60 bits of the md5 of each row, summed, so the result does not depend on row order.
+            query = f"SELECT COUNT(*), SUM(('x' || LEFT(MD5(t::text), 15))::bit(60)::bigint) FROM {table_name} AS t"
+        else:
+            query = f"SELECT COUNT(*), MAX(id) FROM {table_name}"
+        with engine.connect() as connection:
+            row = connection.execute(text(query)).one()
+        return f"{table_name}:{row[0]}:{row[1]}"
+    def fingerprint_file(self, path):
+        stat = os.stat(path)
+        return f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def save(self, df, fingerprint, watermark = None):
+        table = pa.Table.from_pandas(df)
+        metadata = {**(table.schema.metadata or {}), b"fingerprint": fingerprint.encode()}
+        if watermark is not None:
+            metadata[b"watermark"] = json.dumps(watermark).encode()
+        table = table.replace_schema_metadata(metadata)
+        # Write to a temporary file first so a reader never sees a half-written cache.
+        feather.write_feather(table, self.path + ".tmp", compression = "uncompressed")
+        os.replace(self.path + ".tmp", self.path)
+
+    def load(self, fingerprint):
+        if not os.path.exists(self.path):
+            return None
+        with pa.memory_map(self.path) as source:
+            reader = pa.ipc.open_file(source)
+            if fingerprint is not None and (reader.schema.metadata or {}).get(b"fingerprint") != fingerprint.encode():
+                return None
+            return reader.read_all().to_pandas(split_blocks = True)
+
+    def load_watermark(self):
+        if not os.path.exists(self.path):
+            return None
+        with pa.memory_map(self.path) as source:
+            watermark = (pa.ipc.open_file(source).schema.metadata or {}).get(b"watermark")
+        return json.loads(watermark) if watermark else None
+
+def load_typed_df(path = "loan_payments.csv", cache = None):
+    # Returns the typed data frame from the cache, rebuilding the cache from the csv file when the file has changed.
+    cache = cache or TypedCache()
+    fingerprint = cache.fingerprint_file(path)
+    df = cache.load(fingerprint)
+    if df is None:
+        df = csv_to_typed_df(path)
+        transform = DataTransform(df)
+        df = transform.change_data_type_datetime(transform.change_data_type_category(df))
+        cache.save(df, fingerprint)
+    return df
+
+# payments_df = load_typed_df()
+# The typed data frame is now built lazily by the "typecast" stage of LoanPipeline below.
+
+
+class CorrelationAccumulator:
+    """
+    Mergeable pairwise Pearson correlation of numeric columns, built block by block with matrix products.
+
+    Parameters:
+    ----------
+    columns: list
+        The numeric columns to correlate.
+    dtype: numpy dtype
+        Data type of the matrix products. Defaults to np.float64; np.float32 halves the memory of each block and doubles BLAS throughput,
+        with correlations accurate to about 1e-5. The sums are always accumulated in float64.
+
+    Attributes:
+    ----------
+    columns: list
+        Check Parameters section.
+    shift, scale: numpy arrays
+        The per-column mean and standard deviation of the first block. Values are standardised with them before the matrix products,
+        which keeps the sums small and accurate (and in range for float32). Correlations do not depend on either.
+    n, s, q, p: numpy arrays
+        For every pair of columns i, j over the rows where both are not null: the row count, the sum of column i, the sum of squares of column i
+        and the sum of products of i and j.
+
+    Methods:
+    ----------
+    update(df)
+        Adds a block of rows. Nulls are handled pairwise, like pandas corr, with four matrix products per block.
+    merge(other)
+        Adds the sums of another accumulator built on different rows, re-basing them if the two used a different shift or scale.
+    result()
+        Returns the correlation matrix as a data frame, which matches df.corr(numeric_only=True).
+    """
+
+    # Class constructor
+    def __init__(self, columns, dtype = np.float64):
+        self.columns = list(columns)
+        self.dtype = dtype
+        self.shift = None
+        self.scale = None
+        size = len(self.columns)
+        self.n, self.s, self.q, self.p = (np.zeros((size, size)) for _ in range(4))
+
+    # Methods
+    def update(self, df):
+        values = df[self.columns].to_numpy(dtype = np.float64, na_value = np.nan)
+        valid = ~np.isnan(values)
+        if not len(values):
+            return self
+        if self.shift is None:
+            with np.errstate(invalid = "ignore"), warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                self.shift = np.nan_to_num(np.nanmean(values, axis = 0))
+                scale = np.nanstd(values, axis = 0)
+            self.scale = np.where(np.isfinite(scale) & (scale > 0), scale, 1.0)
+        shifted = np.where(valid, (values - self.shift) / self.scale, 0.0).astype(self.dtype, copy = False)
+        valid = valid.astype(self.dtype)
+        self.n += valid.T @ valid
+        self.s += shifted.T @ valid
+        self.q += (shifted * shifted).T @ valid
+        self.p += shifted.T @ shifted
+        return self
+
+    def merge(self, other):
+        if other.shift is None:
+            return self
+        if self.shift is None:
+            self.shift, self.scale = other.shift, other.scale
+        # Re-base the other sums onto this scale and shift: (x - a) / c = (x - b) / d * (d / c) + (b - a) / c.
+        ratio = other.scale / self.scale
+        other_s, other_q, other_p = other.s * ratio[:, None], other.q * (ratio ** 2)[:, None], other.p * np.outer(ratio, ratio)
+        delta = (other.shift - self.shift) / self.scale
+        self.p += other_p + delta[None, :] * other_s + delta[:, None] * other_s.T + np.outer(delta, delta) * other.n
+        self.q += other_q + 2 * delta[:, None] * other_s + (delta ** 2)[:, None] * other.n
+        self.s += other_s + delta[:, None] * other.n
+        self.n += other.n
+        return self
+
+    def result(self):
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            covariance = self.n * self.p - self.s * self.s.T
+            variance = self.n * self.q - self.s * self.s
+            corr = covariance / np.sqrt(variance * variance.T)
+        corr[(self.n < 2) | (variance <= 0) | (variance.T <= 0)] = np.nan
+        return pd.DataFrame(np.clip(corr, -1, 1), index = self.columns, columns = self.columns)
+
+class StatsAccumulator:
+    """
+    Mergeable statistics of every column of a data frame, built chunk by chunk. Used by DataFrameInfo.profile.
+
+    Parameters:
+    ----------
+    corr: boolean
+        Whether to also accumulate the correlation matrix of the numeric columns. Defaults to False.
+
+    Attributes:
+    ----------
+    columns: dictionary
+        The partial statistics of each column: count, nulls, mean, m2 and m3 (sums of squared and cubed deviations from the mean),
+        and the counts of each distinct value (from which min, max, quantiles and the mode are read). The value counts of merged chunks
+        are only added together when they outgrow the combined counts (see merge_counts), so merging many chunks stays linear.
+        Exact value counts take memory in proportion to the number of distinct values (up to about twice that between combines);
+        use DataFrameInfo.approx_profile when that is too large.
+    correlation: CorrelationAccumulator
+        The partial correlation matrix, or None.
+
+    Methods:
+    ----------
+    update(df)
+        Adds a chunk. Each column array is scanned once and its partial statistics are merged into the running ones.
+    merge(other)
+        Adds the partial statistics of another accumulator, built on a different chunk or partition (possibly in another thread).
+        Counts, min, max and value counts merge exactly, the sums of deviations merge with Pebay's pairwise formulas.
+    result(quantiles, top_k)
+        Returns one row per column with: count, nulls, mean, std, min, quantiles, max, skew, unique, mode and the top_k most frequent values.
+        std and skew use the same bias corrections as pandas. Quantiles are exact (linear interpolation, like pandas),
+        as they are read from the merged value counts.
+    """
+
+    # Class constructor
+    def __init__(self, corr = False):
+        self.columns = {}
+        self.correlation = None
+        self.corr = corr
+
+    # Methods
+    def column_state(self, series):
+        counts = series.value_counts()
+        counts = pd.Series(counts.to_numpy(), index = pd.Index(np.asarray(counts.index)))
+        state = {"count": int(counts.sum()), "nulls": int(len(series) - counts.sum()), "counts": counts[counts > 0], "pending": [], "pending_size": 0,
+                 "numeric": pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series),
+                 "datetime": pd.api.types.is_datetime64_any_dtype(series), "mean": np.nan, "m2": 0.0, "m3": 0.0}
+        if state["numeric"] and state["count"]:
+            values = series.to_numpy(dtype = np.float64, na_value = np.nan)
+            values = values[~np.isnan(values)]
+            state["mean"] = values.mean()
+            deviations = values - state["mean"]
+            squared = deviations * deviations
+            state["m2"] = squared.sum()
+            state["m3"] = squared @ deviations
+        return state
+
+    def merge_state(self, a, b):
+        if not b["count"]:
+            return {**a, "nulls": a["nulls"] + b["nulls"]}
+        if not a["count"]:
+            return {**b, "nulls": a["nulls"] + b["nulls"]}
+        n_a, n_b = a["count"], b["count"]
+        n = n_a + n_b
+        merged = {**a, "count": n, "nulls": a["nulls"] + b["nulls"], **self.merge_counts(a, b)}
+        if a["numeric"]:
+            delta = b["mean"] - a["mean"]
+            merged["mean"] = a["mean"] + delta * n_b / n
+            merged["m2"] = a["m2"] + b["m2"] + delta ** 2 * n_a * n_b / n
+            merged["m3"] = a["m3"] + b["m3"] + delta ** 3 * n_a * n_b * (n_a - n_b) / n ** 2 + 3 * delta * (n_a * b["m2"] - n_b * a["m2"]) / n
+        return merged
+
+    def merge_counts(self, a, b):
+        # The partial value counts are queued and added together only once they are larger than the combined counts,
+        # so each value count is combined a bounded number of times however many chunks are merged.
+        pending = a["pending"] + [b["counts"]] + b["pending"]
+        size = a["pending_size"] + len(b["counts"]) + b["pending_size"]
+        if size <= max(len(a["counts"]), 65536):
+            return {"counts": a["counts"], "pending": pending, "pending_size": size}
+        return {"counts": self.combine_counts(a["counts"], pending), "pending": [], "pending_size": 0}
+    def combine_counts(self, counts, pending):
+        return pd.concat([counts] + pending).groupby(level = 0).sum() if pending else counts
+
+    def update(self, df):
+        other = StatsAccumulator(self.corr)
+        other.columns = {column: self.column_state(df[column]) for column in df.columns}
+        if self.corr:
+            other.correlation = CorrelationAccumulator(df.select_dtypes(include = ["number", "bool"]).columns).update(df)
+        return self.merge(other)
+
+    def merge(self, other):
+        for column, state in other.columns.items():
+            self.columns[column] = self.merge_state(self.columns[column], state) if column in self.columns else state
+        if other.correlation is not None:
+            self.correlation = other.correlation if self.correlation is None else self.correlation.merge(other.correlation)
+        return self
+
+    def quantile(self, counts, q):
+        counts = counts.sort_index()
+        values = counts.index.to_numpy()
+        cumulative = np.cumsum(counts.to_numpy())
+        position = (cumulative[-1] - 1) * q
+        lower, upper = (values[np.searchsorted(cumulative, rank, side = "right")] for rank in (math.floor(position), math.ceil(position)))
+        if np.issubdtype(values.dtype, np.datetime64):
+            return pd.Timestamp(lower + (upper - lower) * (position - math.floor(position)))
+        return float(lower) + (float(upper) - float(lower)) * (position - math.floor(position))
+
+    def result(self, quantiles = (0.25, 0.5, 0.75), top_k = 5):
+        rows = {}
+        for column, state in self.columns.items():
+            n, counts = state["count"], self.combine_counts(state["counts"], state["pending"])
+            ordered = state["numeric"] or state["datetime"]
+            row = {"count": n, "nulls": state["nulls"], "mean": state["mean"] if n else np.nan, "std": np.nan}
+            if state["numeric"] and n > 1:
+                row["std"] = math.sqrt(state["m2"] / (n - 1))
+            row["min"] = counts.index.min() if ordered and n else np.nan
+            for q in quantiles:
+                row[f"{q * 100:g}%"] = self.quantile(counts, q) if ordered and n else np.nan
+            row["max"] = counts.index.max() if ordered and n else np.nan
+            row["skew"] = np.nan
+            if state["numeric"] and n > 2:
+                # Like pandas, sums below 1e-14 are floating point noise (e.g. a constant column) and count as zero.
+                m2, m3 = (0.0 if abs(state[m]) < 1e-14 else state[m] / n for m in ("m2", "m3"))
+                row["skew"] = 0.0 if m2 == 0 else math.sqrt(n * (n - 1)) / (n - 2) * m3 / m2 ** 1.5
+            row["unique"] = len(counts)
+            # Most frequent first, ties broken by value, so the result does not depend on how the rows were chunked.
+            frequent = counts.sort_index().sort_values(ascending = False, kind = "stable")
+            row["mode"] = frequent.index[0] if n else np.nan
+            row["top"] = frequent.head(top_k).to_dict()
+            rows[column] = row
+        return pd.DataFrame.from_dict(rows, orient = "index")
+
+class QuantileSketch:
+    """
+    KLL quantile sketch: a fixed-size, mergeable summary of a numeric column which answers quantile queries approximately.
+
+    Parameters:
+    ----------
+    k: integer
+        Size of the largest compactor. Defaults to 200.
+    seed: integer
+        Seed for the random choices made when compacting, so results are reproducible.
+
+    Attributes:
+    ----------
+    levels: list
+        The compactors. An item in levels[h] stands for 2^h values of the column.
+    n: integer
+        Number of values added.
+    min, max: float
+        Exact minimum and maximum.
+
+    Methods:
+    ----------
+    update(values)
+        Adds an array (or series) of values. Nulls and infinite values are skipped.
+    merge(other)
+        Adds another sketch, e.g. one built on a different chunk.
+    quantile(q)
+        Returns the approximate q quantile.
+
+    Error bound: the rank of a returned quantile is within 2 / k * n of the requested rank q * n (1% of n for k = 200)
+    with high probability, whatever n is and however the values are split into updates and merges (checked in tests/test_sketches.py).
+    The sketch keeps fewer items than its total capacity, about 3 * k plus 8 per level, so memory is constant in practice.
+    """
+
+    # Class constructor
+    def __init__(self, k = 200, seed = 0):
+        self.k = k
+        self.rng = np.random.default_rng(seed)
+        self.levels = [np.empty(0)]
+        self.n = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    # Methods
+    def capacity(self, level):
+        return max(8, math.ceil(self.k * (2 / 3) ** (len(self.levels) - level - 1)))
+
+    def compress(self):
+        # Compactions only happen while the sketch holds more items than its total capacity. Each pass goes up the levels and compacts
+        # every level which has reached its capacity once, stopping as soon as the sketch fits again, as in the KLL paper.
+        while sum(map(len, self.levels)) >= sum(self.capacity(level) for level in range(len(self.levels))):
+            for level in range(len(self.levels)):
+                if len(self.levels[level]) >= self.capacity(level):
+                    if level + 1 == len(self.levels):
+                        self.levels.append(np.empty(0))
+                    items = np.sort(self.levels[level])
+                    # Keep one item back when the count is odd, then promote every other item (from a random offset) with double weight.
+                    even = len(items) - len(items) % 2
+                    self.levels[level + 1] = np.concatenate([self.levels[level + 1], items[self.rng.integers(2):even:2]])
+                    self.levels[level] = items[even:]
+                    if sum(map(len, self.levels)) < sum(self.capacity(level) for level in range(len(self.levels))):
+                        break
+        return self
+
+    def update(self, values):
+        values = np.asarray(values, dtype = np.float64)
+        values = values[np.isfinite(values)]
+        if len(values):
+            self.n += len(values)
+            self.min = min(self.min, values.min())
+            self.max = max(self.max, values.max())
+            self.levels[0] = np.concatenate([self.levels[0], values])
+            self.compress()
+        return self
+
+    def merge(self, other):
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self.compress()
+
+    def quantile(self, q):
+        if not self.n:
+            return np.nan
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2.0 ** level) for level, items in enumerate(self.levels)])
+        order = np.argsort(items, kind = "stable")
+        cumulative = np.cumsum(weights[order])
+        index = min(np.searchsorted(cumulative, q * cumulative[-1]), len(items) - 1)
+        return float(np.clip(items[order][index], self.min, self.max))
+
+class DistinctCounter:
+    """
+    HyperLogLog distinct counter: a fixed-size, mergeable estimate of the number of distinct values in a column.
+
+    Parameters:
+    ----------
+    p: integer
+        The sketch keeps 2^p one-byte registers. Defaults to 14 (16 KB).
+
+    Attributes:
+    ----------
+    registers: numpy array
+        For each register, the highest leading-zero rank seen among the hashes routed to it.
 
+    Methods:
+    ----------
+    update(series)
+        Adds the non-null values of a series. Numbers are hashed as floats, so 3 and 3.0 count as the same value in every chunk.
+    merge(other)
+        Adds another counter built with the same p.
+    count()
+        Returns the estimated number of distinct values.
+
+    Error bound: the relative standard error is 1.04 / sqrt(2^p), about 0.8% for p = 14. Small counts use linear counting and are close to exact.
+    """
+
+    # Class constructor
+    def __init__(self, p = 14):
+        self.p = p
+        self.registers = np.zeros(2 ** p, dtype = np.uint8)
+
+    # Methods
+    def update(self, series):
+        series = series.dropna()
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            series = series.astype(np.float64)
+        hashes = pd.util.hash_pandas_object(series, index = False).to_numpy()
+        register = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        rest = hashes & np.uint64((1 << (64 - self.p)) - 1)
+        # Rank = position of the leftmost 1 bit in the remaining 64 - p bits (64 - p + 1 when they are all 0).
+        bit_length = np.where(rest > 0, np.frexp(rest.astype(np.float64))[1], 0)
+        rank = (64 - self.p - bit_length + 1).astype(np.uint8)
+        np.maximum.at(self.registers, register, rank)
+        return self
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out = self.registers)
+        return self
+
+    def count(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(2.0 ** -self.registers.astype(np.float64))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return estimate
+
+class SketchAccumulator:
+    """
+    Approximate, constant-memory statistics of every column of a data frame, built chunk by chunk. Used by DataFrameInfo.approx_profile.
+
+    Parameters:
+    ----------
+    k: integer
+        Passed to QuantileSketch. Defaults to 200.
+    p: integer
+        Passed to DistinctCounter. Defaults to 14.
+
+    Attributes:
+    ----------
+    columns: dictionary
+        For each column: the count, nulls, a QuantileSketch (numeric columns only) and a DistinctCounter.
+
+    Methods:
+    ----------
+    update(df)
+        Adds a chunk.
+    merge(other)
+        Adds another accumulator built on different chunks.
+    result(quantiles, iqr_k)
+        Returns one row per column with: count, nulls, approximate distinct count, min, quantiles, max, median,
+        and the IQR fences Q1 - iqr_k * IQR and Q3 + iqr_k * IQR used to choose outlier bounds.
+    """
+
+    # Class constructor
+    def __init__(self, k = 200, p = 14):
+        self.k = k
+        self.p = p
+        self.columns = {}
+
+    # Methods
+    def update(self, df):
+        for column in df.columns:
+            state = self.columns.setdefault(column, {"count": 0, "nulls": 0, "sketch": None, "distinct": DistinctCounter(self.p)})
+            series = df[column]
+            nulls = int(series.isna().sum())
+            state["count"] += len(series) - nulls
+            state["nulls"] += nulls
+            state["distinct"].update(series)
+            if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+                state["sketch"] = (state["sketch"] or QuantileSketch(self.k)).update(series.to_numpy(dtype = np.float64, na_value = np.nan))
+        return self
+
+    def merge(self, other):
+        for column, state in other.columns.items():
+            if column not in self.columns:
+                self.columns[column] = state
+                continue
+            mine = self.columns[column]
+            mine["count"] += state["count"]
+            mine["nulls"] += state["nulls"]
+            mine["distinct"].merge(state["distinct"])
+            if state["sketch"] is not None:
+                mine["sketch"] = state["sketch"] if mine["sketch"] is None else mine["sketch"].merge(state["sketch"])
+        return self
+
+    def result(self, quantiles = (0.25, 0.5, 0.75), iqr_k = 1.5):
+        rows = {}
+        for column, state in self.columns.items():
+            sketch = state["sketch"]
+            row = {"count": state["count"], "nulls": state["nulls"], "distinct": state["distinct"].count()}
+            row["min"] = sketch.min if sketch and sketch.n else np.nan
+            for q in quantiles:
+                row[f"{q * 100:g}%"] = sketch.quantile(q) if sketch else np.nan
+            row["max"] = sketch.max if sketch and sketch.n else np.nan
+            q1, q3 = (sketch.quantile(0.25), sketch.quantile(0.75)) if sketch else (np.nan, np.nan)
+            row["lower_fence"] = q1 - iqr_k * (q3 - q1)
+            row["upper_fence"] = q3 + iqr_k * (q3 - q1)
+            rows[column] = row
+        return pd.DataFrame.from_dict(rows, orient = "index")
+
+def frame_version(df, columns = None):
+    # Digest of a data frame's index, columns, dtypes and values. Edits made in place (fillna(inplace=True), df.loc[...] = ...)
+    # keep the same object, shape and dtypes, so the values themselves are hashed: numpy columns as raw bytes, others with pandas' hashing.
+    # With columns given, only the values of those columns are hashed (for results which only read them). A series is hashed as a one-column frame.
+    if isinstance(df, pd.Series):
+        df = df.to_frame()
+    digest = hashlib.blake2b(digest_size = 16)
+    digest.update(repr((df.shape, list(df.columns), [str(dtype) for dtype in df.dtypes])).encode())
+    index = df.index
+    digest.update(repr(index).encode() if isinstance(index, pd.RangeIndex) else pd.util.hash_array(np.asarray(index)).tobytes())
+    for column in (column for _, column in df.items()) if columns is None else (df[name] for name in columns):
+        if isinstance(column.dtype, np.dtype) and column.dtype.kind in "biufcmM":
+            digest.update(np.ascontiguousarray(column.to_numpy()).view(np.uint8).data)
+        elif isinstance(column.dtype, pd.CategoricalDtype):
+            digest.update(np.ascontiguousarray(column.cat.codes.to_numpy()).view(np.uint8).data)
+            digest.update(pd.util.hash_array(np.asarray(column.cat.categories, dtype = object)).tobytes())
+        else:
+            digest.update(pd.util.hash_pandas_object(column, index = False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+class FrameCache:
+    """
+    Results computed from data frames, kept while each frame is alive and returned again only while its content is unchanged.
+
+    Attributes:
+    ----------
+    entries: dictionary
+        For each frame (keyed by id): a weak reference to it and its results, each stored with the frame_version it was computed on.
+
+    Methods:
+    ----------
+    get(df, key, compute, refresh, columns)
+        Returns the result stored for df under key if the frame has not changed since, otherwise calls compute() and stores its result.
+        Checking the version hashes the frame once, which is much cheaper than the computations cached here.
+        With columns given, only changes to those columns (the ones compute reads) make the result stale, and only they are hashed.
+    """
+
+    # Class constructor
+    def __init__(self):
+        self.entries = {}
+
+    # Methods
+    def get(self, df, key, compute, refresh = False, columns = None):
+        version = frame_version(df, columns)
+        entry = self.entries.get(id(df))
+        if entry is None or entry[0]() is not df:
+            # Drop the entry when the data frame is garbage collected, so a new frame reusing the id never sees it.
+            weakref.finalize(df, self.entries.pop, id(df), None)
+            entry = self.entries[id(df)] = (weakref.ref(df), {})
+        results = entry[1]
+        if refresh or key not in results or results[key][0] != version:
+            results[key] = (version, compute())
+        return results[key][1]
 
 class DataFrameInfo:
     """
@@ -134,10 +957,26 @@ class DataFrameInfo:
         This function returns the shape (size) of the dataframe.
     df_null_count(df)
         This function returns the null count (number of missing values) for each colum in the dataframe.
+    profile(df, quantiles, top_k, corr, refresh)
+        This function returns all of the above in one call, computed in a single scan of each column with StatsAccumulator:
+        a "columns" data frame (count, nulls, mean, std, min, quantiles, max, skew, unique, mode and top_k values per column)
+        and, if corr is True, a "corr" data frame equal to df.corr(numeric_only=True).
+        Results are cached per data frame (see FrameCache), so repeated calls only hash the frame to check that its values
+        have not changed, in place or otherwise, since the last call. refresh=True recomputes them anyway.
+    profile_chunks(chunks, quantiles, top_k, corr, workers)
+        This function profiles an iterable of data frames (for example a chunked read or the partitions of an extract) in parallel threads
+        and merges the partial statistics, giving the same result as profiling the whole frame at once.
+    approx_profile(chunks, quantiles, iqr_k, k, p, workers)
+        This function returns approximate statistics for data too large for memory, using constant memory per column:
+        counts, nulls, distinct counts (DistinctCounter, about 0.8% error), min/max, quantiles and IQR outlier fences
+        (QuantileSketch, rank error about 1% of the row count). chunks can be a data frame (or a single column) or an iterable of data frames,
+        such as a chunked read_csv or read_sql; they are sketched in parallel threads and merged.
 
     The above methods can also be used on specific columns of the dataframe if only data for some is required.
     """
 
+    PROFILE_CACHE = FrameCache()
+
     # Class constructor
     def __init__(self, df):
         self.df = df
@@ -151,15 +990,87 @@ class DataFrameInfo:
         return df.shape
     def df_null_count(self, df):
         return df.isnull().sum()
+
+    def profile(self, df, quantiles = (0.25, 0.5, 0.75), top_k = 5, corr = False, refresh = False):
+        def compute():
+            # A single column (df["loan_amount"]) is profiled as a one-column frame; the cache is still kept for the series itself.
+            accumulator = StatsAccumulator(corr).update(df.to_frame() if isinstance(df, pd.Series) else df)
+            return {"columns": accumulator.result(quantiles, top_k), "corr": accumulator.correlation.result() if corr else None}
+        return self.PROFILE_CACHE.get(df, ("profile", tuple(quantiles), top_k, corr), compute, refresh)
+
+    def profile_chunks(self, chunks, quantiles = (0.25, 0.5, 0.75), top_k = 5, corr = False, workers = 4):
+        total = StatsAccumulator(corr)
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            for partial in bounded_map(executor, lambda chunk: StatsAccumulator(corr).update(chunk), chunks, 2 * workers):
+                total.merge(partial)
+        return {"columns": total.result(quantiles, top_k), "corr": total.correlation.result() if corr and total.correlation else None}
+
+    def approx_profile(self, chunks, quantiles = (0.25, 0.5, 0.75), iqr_k = 1.5, k = 200, p = 14, workers = 4):
+        if isinstance(chunks, pd.Series):
+            chunks = chunks.to_frame()
+        if isinstance(chunks, pd.DataFrame):
+            chunks = [chunks]
+        total = SketchAccumulator(k, p)
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            for partial in bounded_map(executor, lambda chunk: SketchAccumulator(k, p).update(chunk), chunks, 2 * workers):
+                total.merge(partial)
+        return total.result(quantiles, iqr_k)
     
-DataFrameInfo(payments_df).df_shape(payments_df)
+# DataFrameInfo(pipeline.typecast).df_shape(pipeline.typecast)
 # There are 54231 rows of data.
-DataFrameInfo(payments_df).df_null_count(payments_df)
+# DataFrameInfo(pipeline.typecast).df_null_count(pipeline.typecast)
 # Rows to drop: mths_since_last_delinq (31002 NULL), mths_since_last_record (48050 NULL), next_payment_date (32608 NULL), mths_since_last_major_derog (46732 NULL).
-payments_df = payments_df.drop(["mths_since_last_delinq", "mths_since_last_record", "next_payment_date", "mths_since_last_major_derog"], axis = 1)
-DataFrameInfo(payments_df).df_shape(payments_df)
+# These are dropped by the "drop_sparse" stage of LoanPipeline.
+# DataFrameInfo(pipeline.drop_sparse).df_shape(pipeline.drop_sparse)
 # 4 columns have been dropped
 
+def minmax_downsample(x, y, max_points = 2000):
+    # Splits the points into max_points / 2 bins and keeps the lowest and highest point of each (in x order), so peaks are not lost.
+    y = np.asarray(y, dtype = np.float64)
+    n = len(y)
+    if n <= max_points:
+        return np.asarray(x), y
+    bins = max(max_points // 2, 1)
+    size = -(-n // bins)
+    padded = np.full(bins * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(bins, size)
+    low = np.where(np.isnan(padded), np.inf, padded).argmin(axis = 1)
+    high = np.where(np.isnan(padded), -np.inf, padded).argmax(axis = 1)
+    positions = (np.sort(np.stack([low, high], axis = 1), axis = 1) + np.arange(bins)[:, None] * size).ravel()
+    positions = np.unique(positions[positions < n])
+    return np.asarray(x)[positions], y[positions]
+
+def render_chart(kind, payload, path = None, title = None):
+    # Draws a chart from precomputed data. kind is "null" (payload: series of counts), "line" (payload: {label: (x, y)})
+    # or "box" (payload: list of Axes.bxp statistics). With a path the figure is rendered off screen to that file, without pyplot.
+    if path is None:
+        figure = plt.figure()
+    else:
+        figure = Figure()
+        FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    if kind == "null":
+        axes.bar(range(len(payload)), payload.to_numpy())
+        axes.set_xticks(range(len(payload)), [str(label) for label in payload.index], rotation = 90)
+    elif kind == "line":
+        for label, (x, y) in payload.items():
+            axes.plot(x, y, label = label)
+        if len(payload) > 1:
+            axes.legend()
+    elif kind == "box":
+        axes.bxp(payload, showfliers = False)
+    else:
+        raise ValueError(f"Unknown chart kind '{kind}'")
+    if title:
+        axes.set_title(title)
+    if path is None:
+        plt.show()
+        return None
+    figure.tight_layout()
+    figure.savefig(path)
+    return path
+
 class Plotter:
     """
     This class defines some methods to plot information from the dataframe.
@@ -168,38 +1079,93 @@ class Plotter:
     ----------
     df: pandas dataframe
         This is the dataframe which information will be obtained from.
+    output_dir: string
+        Defaults to None, which shows each chart with plt.show(). When set, charts are rendered off screen (Agg, no display needed)
+        and written to PNG files in this directory, and the plot methods return the file path.
 
     Attributes:
     ----------
     df: pandas dataframe
         Check Parameters section.
+    output_dir: string
+        Check Parameters section.
 
     Methods:
     ----------
     plot_null(df)
         This function plots a bar chart of the sum of null values for each column of the data frame.
-    plot_data_boxplot(df)
+    plot_data_boxplot(df, stats, iqr_k)
         This function returns a boxplot to help visualise the data.
         This is best used for one column of the data frame at a time like: df["column name"].
-    plot_data_line(df)
+        The boxes are drawn from quartiles rather than from the raw points. These are computed in one pass, or taken from stats,
+        a data frame of quantiles per column such as DataFrameInfo.profile(df)["columns"] or DataFrameInfo.approx_profile(chunks),
+        in which case the whiskers are the fences clipped to the minimum and maximum. Outliers are not drawn.
+    plot_data_line(df, max_points)
         This function returns a line graph to help visualise the data.
         This is best used for one column of the data frame at a time like: df["column name"].
+        Each line is reduced to at most max_points points with min/max binning (see minmax_downsample).
+        Given a whole data frame, one line is drawn per numeric column, as in plot_data_boxplot.
+    render_report(df, columns, stats, max_points, workers)
+        This function writes the null chart and a line and box plot of every numeric column (or of columns) to output_dir.
+        The downsampled lines and box statistics are computed here; the figures are drawn in parallel by worker processes.
+        Returns a dictionary of chart name to file path.
     """
 
     # Class constructor
-    def __init__(self, df):
+    def __init__(self, df, output_dir = None):
         self.df = df
+        self.output_dir = output_dir
     
     # Methods
+    def path(self, name):
+        if self.output_dir is None:
+            return None
+        os.makedirs(self.output_dir, exist_ok = True)
+        return os.path.join(self.output_dir, f"{name}.png")
+
+    def line_payload(self, df, max_points = 2000):
+        columns = {df.name: df} if isinstance(df, pd.Series) else dict(df.select_dtypes(include = "number").items())
+        x = df.index if pd.api.types.is_numeric_dtype(df.index) or pd.api.types.is_datetime64_any_dtype(df.index) else np.arange(len(df))
+        return {label: minmax_downsample(x, column.to_numpy(np.float64, na_value = np.nan), max_points) for label, column in columns.items()}
+    def box_payload(self, df, stats = None, iqr_k = 1.5):
+        columns = {df.name: df} if isinstance(df, pd.Series) else dict(df.select_dtypes(include = "number").items())
+        payload = []
+        for label, column in columns.items():
+            if stats is not None:
+                row = stats.loc[label]
+                q1, median, q3, low, high = (float(row[key]) for key in ["25%", "50%", "75%", "min", "max"])
+            else:
+                values = column.to_numpy(np.float64, na_value = np.nan)
+                values = values[~np.isnan(values)]
+                if not len(values):
+                    continue
+                q1, median, q3 = np.quantile(values, [0.25, 0.5, 0.75])
+                low, high = values.min(), values.max()
+            lower_fence, upper_fence = q1 - iqr_k * (q3 - q1), q3 + iqr_k * (q3 - q1)
+            if stats is None:
+                # Like plt.boxplot, the whiskers end at the furthest points inside the fences.
+                low, high = values[values >= lower_fence].min(), values[values <= upper_fence].max()
+            payload.append({"label": label, "q1": q1, "med": median, "q3": q3, "whislo": max(low, lower_fence), "whishi": min(high, upper_fence)})
+        return payload
+
     def plot_null(self, df):
-        df.isna().sum().plot(kind = "bar")
-        plt.show()
-    def plot_data_boxplot(self, df):
-        df.plot(kind = "box")
-        plt.show()
-    def plot_data_line(self, df):
-        df.plot()
-        plt.show()
+        return render_chart("null", df.isna().sum(), self.path("null_counts"))
+    def plot_data_boxplot(self, df, stats = None, iqr_k = 1.5):
+        return render_chart("box", self.box_payload(df, stats, iqr_k), self.path(f"{getattr(df, 'name', None) or 'columns'}_box"))
+    def plot_data_line(self, df, max_points = 2000):
+        return render_chart("line", self.line_payload(df, max_points), self.path(f"{getattr(df, 'name', None) or 'columns'}_line"))
+
+    def render_report(self, df, columns = None, stats = None, max_points = 2000, workers = 4):
+        if self.output_dir is None:
+            raise ValueError("render_report writes files; set output_dir first")
+        columns = columns or list(df.select_dtypes(include = "number").columns)
+        charts = {"null_counts": ("null", df.isna().sum(), None)}
+        for column in columns:
+            charts[f"{column}_line"] = ("line", self.line_payload(df[column], max_points), column)
+            charts[f"{column}_box"] = ("box", self.box_payload(df[column], stats), column)
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            futures = {name: executor.submit(render_chart, kind, payload, self.path(name), title) for name, (kind, payload, title) in charts.items()}
+            return {name: future.result() for name, future in futures.items()}
 
 # Plotter(payments_df).plot_null(payments_df)
 # The function above returns showing how many null values there are in each column.
@@ -217,6 +1183,10 @@ class DataFrameTransform:
     ----------
     df: pandas dataframe
         Check Parameters section.
+    outlier_stats: pandas dataframe
+        The number of rows rejected by each outlier rule in the last call to remove_outliers (see OutlierRules.apply).
+    prune_report: pandas dataframe
+        The columns dropped by the last call to prune_correlated, each with the kept column it was paired with and their correlation.
 
     Methods:
     ----------
@@ -226,10 +1196,17 @@ class DataFrameTransform:
         MEDIAN: collections_12_mths_ex_med
         FORWARD FILL: last_payment_date, last_credit_pull_date
         MODE: term, employment_length
-    reduce_skew(df)
+        Only the missing values are replaced. To impute new batches with the statistics of this data frame, use TransformPlan.
+        With workers above 1, the mean and median columns are filled in place by a thread pool (see reduce_skew).
+    reduce_skew(df, workers, float32, block_rows)
         This function reduces the skew of some columns using either the log or square root transformations as follows:
         LOG: annual_inc, out_prncp, out_prncp_inv, total_rec_late_fee, recoveries, collection_recovery_fee, last_payment_amount.
         SQRT: delinq_2yrs, inq_last_6mths, total_rec_int.
+        With workers above 1 or float32=True, each column is copied once into its output buffer (float32 halves its size) and transformed in place
+        with np.log1p / np.sqrt (out=), in row blocks (at most block_rows) spread over a thread pool, as numpy releases the GIL for these.
+        This avoids the temporaries of np.log(df[column]+1). In float64 the buffer is written back into the column's existing storage,
+        so the peak extra memory is about one column; float32 columns replace the old ones instead.
+        log1p is slightly more accurate than log(x+1), so the last digits can differ. benchmark.py compares the modes.
     remove_outliers(df)
         This function removes outliers from the data as follows:
         OUTLIERS: instalment (remove above 1000), annual_inc (remove above 12.35 & under 9.70), delinq_2yrs (remove above 0), inq_last_6mths (remove above 2.5),
@@ -237,36 +1214,119 @@ class DataFrameTransform:
                   total_rec_prncp (remove above 24,870), total_rec_int (remove above 100), total_rec_late_fee (remove above 0), recoveries (remove above 0),
                   collection_recovery_fee (remove above 0), last_payment_amount (remove under 1.8).
         NO OUTLIERS: loan_amount, funded_amount, funded_amount_inv, int_rate, dti, out_prncp, out_prncp_inv, collections_12_mths_ex_med, policy_code.
+        The outliers are declared as data in OUTLIER_RULES, a list of (column, operator, value) rules which a row has to meet to be kept.
+        A different list (or an OutlierRules object, e.g. from OutlierRules.from_fences) can be passed in. The rules are evaluated by OutlierRules
+        in one fused pass, and the number of rows each rule rejected is kept in outlier_stats.
+        SQLBackend.remove_outliers runs the same rules in the database.
+    correlated_columns(chunks, threshold, keep, float32, block_rows, exclude)
+        This function finds the columns to drop because they are highly correlated with another one. The correlation matrix of the numeric columns
+        is built with CorrelationAccumulator, one block of block_rows rows at a time (standardised float32 matrix products by default),
+        so chunks can be a data frame or an iterable of data frames larger than memory. Columns are then taken in order and a column is dropped
+        when its absolute correlation with a column already kept is above threshold; columns in keep are never dropped.
+        The columns in exclude (by default IDENTIFIER_COLUMNS: the loan and member ids and the csv index) are left out altogether,
+        as keys are never dropped and should not cause other columns to be dropped either.
+        Returns a data frame with each dropped column, the kept column it was paired with and their correlation.
+    prune_correlated(df, threshold, keep, float32, block_rows, exclude)
+        This function drops the columns found by correlated_columns from df and keeps the report in prune_report.
+        LoanPipeline uses it for the "prune_correlated" stage when its columns parameter is set to None (instead of the list chosen by hand).
     """
 
+    MEAN_COLUMNS = ["funded_amount", "int_rate"]
+    MEDIAN_COLUMNS = ["collections_12_mths_ex_med"]
+    FFILL_COLUMNS = ["last_payment_date", "last_credit_pull_date"]
+    MODE_COLUMNS = ["term", "employment_length"]
+    LOG_COLUMNS = ["annual_inc", "out_prncp", "out_prncp_inv", "total_rec_late_fee", "recoveries", "collection_recovery_fee", "last_payment_amount"]
+    SQRT_COLUMNS = ["delinq_2yrs", "inq_last_6mths", "total_rec_int"]
+    OUTLIER_RULES = [("instalment", "<=", 1000), ("annual_inc", "<=", 12.35), ("annual_inc", ">=", 9.70), ("delinq_2yrs", "==", 0), ("inq_last_6mths", "<=", 2.5),
+                     ("open_accounts", "<=", 22), ("total_accounts", "<=", 53.5), ("total_payment", "<=", 31850), ("total_payment_inv", "<=", 31500),
+                     ("total_rec_prncp", "<=", 24870), ("total_rec_int", "<=", 100), ("total_rec_late_fee", "==", 0), ("recoveries", "==", 0),
+                     ("collection_recovery_fee", "==", 0), ("last_payment_amount", ">=", 1.8)]
+    IDENTIFIER_COLUMNS = ["Unnamed: 0", "id", "member_id"]
+    OPERATORS = {"<=": operator.le, "<": operator.lt, ">=": operator.ge, ">": operator.gt, "==": operator.eq}
+
     # Class constructor
     def __init__(self, df):
         self.df = df
+        self.outlier_stats = None
+        self.prune_report = None
 
     # Methods
-    def impute_missing(self, df):
-        for column in ["funded_amount", "int_rate"]:
-            df[column] = df[column].fillna(df[column]).mean()
-        for column in ["collections_12_mths_ex_med"]:
-            df[column] = df[column].fillna(df[column]).median()
-        for column in ["last_payment_date", "last_credit_pull_date"]:
+    def impute_missing(self, df, workers = 1):
+        if workers > 1:
+            fills = {column: df[column].mean() for column in self.MEAN_COLUMNS}
+            fills.update({column: df[column].median() for column in self.MEDIAN_COLUMNS})
+            self.transform_in_place(df, fills, lambda block, value: np.copyto(block, value, where = np.isnan(block)), workers, False)
+        else:
+            for column in self.MEAN_COLUMNS:
+                df[column] = df[column].fillna(df[column].mean())
+            for column in self.MEDIAN_COLUMNS:
+                df[column] = df[column].fillna(df[column].median())
+        for column in self.FFILL_COLUMNS:
             df[column] = df[column].ffill()
-        for column in ["term", "employment_length"]:
-            df[column] = df[column].fillna(df[column]).mode()[0]
+        for column in self.MODE_COLUMNS:
+            df[column] = df[column].fillna(df[column].mode()[0])
         return df
         
-    def reduce_skew(self, df):
-        for column in ["annual_inc", "out_prncp", "out_prncp_inv", "total_rec_late_fee", "recoveries", "collection_recovery_fee", "last_payment_amount"]:
+    def reduce_skew(self, df, workers = 1, float32 = False, block_rows = 1_000_000):
+        if workers > 1 or float32:
+            functions = {**{column: np.log1p for column in self.LOG_COLUMNS}, **{column: np.sqrt for column in self.SQRT_COLUMNS}}
+            return self.transform_in_place(df, functions, lambda block, function: function(block, out = block), workers, float32, block_rows)
+        for column in self.LOG_COLUMNS:
             df[column] = np.log(df[column]+1)
-        for column in ["delinq_2yrs", "inq_last_6mths", "total_rec_int"]:
+        for column in self.SQRT_COLUMNS:
             df[column] = np.sqrt(df[column])
         return df
+
+    def correlated_columns(self, chunks, threshold = 0.9, keep = (), float32 = True, block_rows = 100_000, exclude = None):
+        if isinstance(chunks, pd.DataFrame):
+            chunks = [chunks]
+        exclude = self.IDENTIFIER_COLUMNS if exclude is None else exclude
+        accumulator = None
+        for chunk in chunks:
+            numeric = chunk.select_dtypes(include = ["number", "bool"])
+            numeric = numeric.drop([column for column in exclude if column in numeric.columns], axis = 1)
+            accumulator = accumulator or CorrelationAccumulator(numeric.columns, np.float32 if float32 else np.float64)
+            for start in range(0, len(numeric), block_rows):
+                accumulator.update(numeric.iloc[start:start + block_rows])
+        dropped = []
+        if accumulator is not None:
+            signed = accumulator.result()
+            corr = signed.abs()
+            # Columns in keep are considered first, so they are always kept.
+            order = [column for column in keep if column in corr.columns] + [column for column in corr.columns if column not in keep]
+            kept = []
+            for column in order:
+                pairs = corr.loc[column, kept] if kept else pd.Series(dtype = np.float64)
+                if column not in keep and len(pairs) and pairs.max() > threshold:
+                    dropped.append({"dropped": column, "paired_with": pairs.idxmax(), "correlation": signed.loc[column, pairs.idxmax()]})
+                else:
+                    kept.append(column)
+        return pd.DataFrame(dropped, columns = ["dropped", "paired_with", "correlation"])
+
+    def prune_correlated(self, df, threshold = 0.9, keep = (), float32 = True, block_rows = 100_000, exclude = None):
+        self.prune_report = self.correlated_columns(df, threshold, keep, float32, block_rows, exclude)
+        return df.drop(list(self.prune_report["dropped"]), axis = 1)
+
+    def transform_in_place(self, df, arguments, operation, workers, float32, block_rows = 1_000_000):
+        # Copies one column at a time into its output buffer and runs operation(block, argument) on row blocks of it in a thread pool.
+        # A column which already has the output dtype gets the buffer written back into its existing storage (df.loc), so only one extra column
+        # is alive at any time. Assigning a new series instead would split the column out of its consolidated block, copying the rest of it.
+        # Other columns (float32 output, other dtypes) are replaced by the buffer, as their dtype changes.
+        dtype = np.float32 if float32 else np.float64
+        block_rows = max(1, min(block_rows, math.ceil(len(df) / max(1, workers))))
+        with ThreadPoolExecutor(max_workers = max(1, workers)) as executor:
+            for column, argument in arguments.items():
+                buffer = df[column].to_numpy(dtype = dtype, na_value = np.nan, copy = True)
+                list(executor.map(lambda start: operation(buffer[start:start + block_rows], argument), range(0, len(buffer), block_rows)))
+                if df[column].dtype == dtype:
+                    df.loc[:, column] = buffer
+                else:
+                    df[column] = pd.Series(buffer, index = df.index, copy = False)
+        return df
         
-    def remove_outliers(self, df):
-        df = df[(df["instalment"] <= 1000) & (df["annual_inc"] <= 12.35) & (df["annual_inc"] >= 9.70) & (df["delinq_2yrs"] == 0) & (df["inq_last_6mths"] <= 2.5) &
-                (df["open_accounts"] <= 22) & (df["total_accounts"] <= 53.5) & (df["total_payment"] <= 31850) & (df["total_payment_inv"] <= 31500) &
-                (df["total_rec_prncp"] <= 24870) & (df["total_rec_int"] <= 100) & (df["total_rec_late_fee"] == 0) & (df["recoveries"] == 0) &
-                (df["collection_recovery_fee"] == 0) & (df["last_payment_amount"] >= 1.8)]
+    def remove_outliers(self, df, rules = None):
+        rules = rules if isinstance(rules, OutlierRules) else OutlierRules(rules or self.OUTLIER_RULES)
+        df, self.outlier_stats = rules.apply(df)
         return df
         # OUTLIERS: instalment (remove above 1000), annual_inc (remove above 12.35 & under 9.70), delinq_2yrs (remove above 0), inq_last_6mths (remove above 2.5),
         #           open_accounts (remove above 22), total_accounts (remove above 53.5), total_payment (remove above 31,850), total_payment_inv (remove above 31,500),
@@ -276,40 +1336,803 @@ class DataFrameTransform:
 
 
 
-payments_df = DataFrameTransform(payments_df).impute_missing(payments_df)
-DataFrameInfo(payments_df).df_null_count(payments_df)
+class OutlierRules:
+    """
+    Outlier rules declared as data and compiled into a single fused mask evaluation.
+
+    Parameters:
+    ----------
+    rules: list or dictionary
+        Either a list of (column, operator, value) rules, like DataFrameTransform.OUTLIER_RULES,
+        or a dictionary such as {"annual_inc": {">=": 9.70, "<=": 12.35}} (for example loaded from a yaml or json config file).
+        The operators are <=, <, >=, > and ==. A row is kept when it meets every rule; a null never meets a rule.
+    block_size: integer
+        Number of rows evaluated at a time. Defaults to 65536.
+
+    Attributes:
+    ----------
+    rules: list
+        The rules as (column, operator, value) tuples, in evaluation order.
+    block_size: integer
+        Check Parameters section.
+
+    Methods:
+    ----------
+    from_fences(stats, columns, method, k)
+        Builds rules from a profile (the "columns" data frame of DataFrameInfo.profile, or DataFrameInfo.approx_profile for data larger than memory).
+        method "iqr" keeps Q1 - k * IQR <= x <= Q3 + k * IQR (default k = 1.5), method "zscore" keeps mean - k * std <= x <= mean + k * std (needs profile).
+    mask(df)
+        Returns the boolean keep mask and the per-rule rejection counts. The rows are evaluated block by block into two reusable block-sized buffers,
+        rule after rule, and a block stops as soon as none of its rows are left, so no full-length temporary is built for any rule.
+        A row is counted against the first rule it fails, in rule order.
+    apply(df)
+        Returns the rows which are kept (one copy of the frame) and a data frame with the rejection count of every rule.
+    """
+
+    UFUNCS = {"<=": np.less_equal, "<": np.less, ">=": np.greater_equal, ">": np.greater, "==": np.equal}
+
+    # Class constructor
+    def __init__(self, rules, block_size = 65536):
+        if isinstance(rules, dict):
+            rules = [(column, op, value) for column, bounds in rules.items() for op, value in bounds.items()]
+        self.rules = [tuple(rule) for rule in rules]
+        for column, op, value in self.rules:
+            if op not in self.UFUNCS:
+                raise ValueError(f"Unknown operator {op!r} in the rule for {column}")
+        self.block_size = block_size
+
+    @classmethod
+    def from_fences(cls, stats, columns, method = "iqr", k = 1.5):
+        rules = []
+        for column in columns:
+            if method == "iqr":
+                q1, q3 = stats.loc[column, "25%"], stats.loc[column, "75%"]
+                lower, upper = q1 - k * (q3 - q1), q3 + k * (q3 - q1)
+            elif method == "zscore":
+                lower, upper = stats.loc[column, "mean"] - k * stats.loc[column, "std"], stats.loc[column, "mean"] + k * stats.loc[column, "std"]
+            else:
+                raise ValueError(f"Unknown fence method {method!r}, use 'iqr' or 'zscore'")
+            rules += [(column, ">=", float(lower)), (column, "<=", float(upper))]
+        return cls(rules)
+
+    # Methods
+    def mask(self, df):
+        # Views of the column arrays; only columns which are not plain numpy numbers (e.g. nullable Int64) are converted.
+        arrays = {}
+        for column, op, value in self.rules:
+            if column not in arrays:
+                series = df[column]
+                arrays[column] = series.to_numpy() if isinstance(series.dtype, np.dtype) and series.dtype.kind in "biuf" else series.to_numpy(dtype = np.float64, na_value = np.nan)
+        keep = np.ones(len(df), dtype = bool)
+        rejected = np.zeros(len(self.rules), dtype = np.int64)
+        passed = np.empty(min(self.block_size, len(df)), dtype = bool)
+        for start in range(0, len(df), self.block_size):
+            alive = keep[start:start + self.block_size]
+            test = passed[:len(alive)]
+            remaining = len(alive)
+            for index, (column, op, value) in enumerate(self.rules):
+                self.UFUNCS[op](arrays[column][start:start + self.block_size], value, out = test)
+                np.logical_and(alive, test, out = alive)
+                left = np.count_nonzero(alive)
+                rejected[index] += remaining - left
+                remaining = left
+                if not remaining:
+                    break
+        stats = pd.DataFrame(self.rules, columns = ["column", "operator", "value"])
+        stats["rejected"] = rejected
+        return keep, stats
+
+    def apply(self, df):
+        keep, stats = self.mask(df)
+        return df[keep], stats
+
+class TransformPlan:
+    """
+    Learns the settings of DataFrameTransform once (fit) and applies them to any new batch (transform) without looking at earlier data.
+
+    Parameters:
+    ----------
+    auto_skew: boolean
+        When False (default) the log and square root columns of DataFrameTransform are used. When True, every numeric column with
+        an absolute skew above skew_threshold gets whichever of the two transforms leaves the smaller absolute skew on the fitted data.
+    skew_threshold: float
+        Defaults to 2, the threshold used to choose the columns of DataFrameTransform.
+    fences: string
+        None (default) to use DataFrameTransform.OUTLIER_RULES, or "iqr" / "zscore" to learn outlier bounds for fence_columns
+        from the fitted data after the skew transforms (see OutlierRules.from_fences).
+    fence_columns: list
+        The columns to learn fences for. Defaults to the columns of DataFrameTransform.OUTLIER_RULES.
+
+    Attributes:
+    ----------
+    fill_values: dictionary
+        The mean, median or mode of each imputed column, learned by fit.
+    ffill_values: dictionary
+        The last known value of each forward filled column. It is used for missing values at the start of a batch and
+        is updated after each batch, so consecutive batches are filled as if they were one frame.
+    skew: dictionary
+        "log" or "sqrt" for each transformed column.
+    rules: list
+        The outlier rules, as (column, operator, value) tuples.
+
+    Methods:
+    ----------
+    fit(df)
+        Learns the imputation statistics, the skew transforms and the outlier bounds from df. Returns the plan.
+    transform(batch, remove_outliers)
+        Imputes, transforms and (unless remove_outliers is False) filters a copy of the batch, in O(batch) time.
+        Returns the batch and the per-rule outlier stats.
+    save(path)
+        Writes the plan to a small json file.
+    load(path)
+        Reads a plan written by save.
+    """
+
+    # Class constructor
+    def __init__(self, auto_skew = False, skew_threshold = 2, fences = None, fence_columns = None):
+        self.auto_skew = auto_skew
+        self.skew_threshold = skew_threshold
+        self.fences = fences
+        self.fence_columns = fence_columns
+        self.fill_values = {}
+        self.ffill_values = {}
+        self.skew = {}
+        self.rules = []
+
+    # Methods
+    def fit(self, df):
+        self.fill_values = {column: float(df[column].mean()) for column in DataFrameTransform.MEAN_COLUMNS}
+        self.fill_values.update({column: float(df[column].median()) for column in DataFrameTransform.MEDIAN_COLUMNS})
+        self.fill_values.update({column: df[column].mode()[0] for column in DataFrameTransform.MODE_COLUMNS})
+        self.ffill_values = {}
+        self.update_ffill(df)
+        imputed = DataFrameTransform(df).impute_missing(df.copy())
+        if self.auto_skew:
+            self.skew = {}
+            skews = imputed.skew(numeric_only = True)
+            for column in skews[skews.abs() > self.skew_threshold].index:
+                values = imputed[column]
+                if values.min() < 0:
+                    continue
+                log_skew, sqrt_skew = abs(np.log(values + 1).skew()), abs(np.sqrt(values).skew())
+                self.skew[column] = "log" if log_skew <= sqrt_skew else "sqrt"
+        else:
+            self.skew = {**{column: "log" for column in DataFrameTransform.LOG_COLUMNS}, **{column: "sqrt" for column in DataFrameTransform.SQRT_COLUMNS}}
+        if self.fences:
+            columns = self.fence_columns or list(dict.fromkeys(rule[0] for rule in DataFrameTransform.OUTLIER_RULES))
+            deskewed = self.reduce_skew(imputed)
+            stats = DataFrameInfo(deskewed).profile(deskewed[columns])["columns"]
+            self.rules = OutlierRules.from_fences(stats, columns, self.fences).rules
+        else:
+            self.rules = list(DataFrameTransform.OUTLIER_RULES)
+        return self
+
+    def update_ffill(self, df):
+        for column in DataFrameTransform.FFILL_COLUMNS:
+            known = df[column].dropna()
+            if len(known):
+                self.ffill_values[column] = known.iloc[-1]
+
+    def reduce_skew(self, df):
+        transform = DataFrameTransform(df)
+        transform.LOG_COLUMNS = [column for column, kind in self.skew.items() if kind == "log"]
+        transform.SQRT_COLUMNS = [column for column, kind in self.skew.items() if kind == "sqrt"]
+        return transform.reduce_skew(df)
+
+    def transform(self, batch, remove_outliers = True):
+        batch = batch.copy()
+        for column, value in self.fill_values.items():
+            column_values = batch[column]
+            # A small batch may not have the learned value among its categories (e.g. no 36 month loans), and fillna cannot add one.
+            if isinstance(column_values.dtype, pd.CategoricalDtype) and value not in column_values.cat.categories:
+                column_values = column_values.cat.add_categories([value])
+            batch[column] = column_values.fillna(value)
+        for column in DataFrameTransform.FFILL_COLUMNS:
+            filled = batch[column].ffill()
+            if column in self.ffill_values:
+                filled = filled.fillna(pd.Timestamp(self.ffill_values[column]) if pd.api.types.is_datetime64_any_dtype(filled) else self.ffill_values[column])
+            batch[column] = filled
+        self.update_ffill(batch)
+        batch = self.reduce_skew(batch)
+        if not remove_outliers:
+            return batch, None
+        return OutlierRules(self.rules).apply(batch)
+
+    def save(self, path):
+        plan = {"auto_skew": self.auto_skew, "skew_threshold": self.skew_threshold, "fences": self.fences, "fence_columns": self.fence_columns,
+                "fill_values": self.fill_values, "ffill_values": self.ffill_values, "skew": self.skew, "rules": self.rules}
+        with open(path, "w") as stream:
+            json.dump(plan, stream, indent = 2, default = lambda value: value.isoformat() if hasattr(value, "isoformat") else str(value))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as stream:
+            plan = json.load(stream)
+        loaded = cls(plan["auto_skew"], plan["skew_threshold"], plan["fences"], plan["fence_columns"])
+        loaded.fill_values, loaded.ffill_values, loaded.skew = plan["fill_values"], plan["ffill_values"], plan["skew"]
+        loaded.rules = [tuple(rule) for rule in plan["rules"]]
+        return loaded
+
+def code_fingerprint(function):
+    # Hash of a function's bytecode, constants and referenced names, so editing the function changes the fingerprint.
+    digest = hashlib.sha256()
+    # Instrumentation wraps functions while it is enabled; fingerprint the original so cached stages stay valid.
+    codes = [getattr(function, "__wrapped__", function).__code__]
+    while codes:
+        code = codes.pop()
+        digest.update(code.co_code)
+        digest.update(repr(code.co_names).encode())
+        for const in code.co_consts:
+            if hasattr(const, "co_code"):
+                codes.append(const)
+            else:
+                digest.update(repr(const).encode())
+    return digest.hexdigest()
+
+class LoanPipeline:
+    """
+    Runs the cleaning steps of this file as named stages which are only computed when they are first accessed.
+
+    Parameters:
+    ----------
+    path: string
+        The csv file obtained with the RDSDatabaseConnector class. Defaults to "loan_payments.csv".
+    cache_dir: string
+        Directory where the output of every stage is stored as a TypedCache file. Defaults to ".pipeline_cache".
+
+    Attributes:
+    ----------
+    path: string
+        Check Parameters section.
+    cache_dir: string
+        Check Parameters section.
+    params: dictionary
+        The parameters of each stage, keyed by stage name.
+    load, typecast, drop_sparse, impute, deskew, outliers, prune_correlated: pandas dataframe
+        The output of each stage, in order. Accessing a stage computes it (and any stage before it) on first access only.
+
+    Methods:
+    ----------
+    stage_key(stage)
+        Returns the key of a stage, a hash of the previous stage's key, the stage's parameters and the code it runs.
+        The key of the "load" stage includes the fingerprint of the csv file, so changing the file recomputes every stage.
+    get(stage)
+        Returns the output of a stage from memory, then from the cache directory, and only computes it when neither has it.
+    set_params(stage, **params)
+        Changes the parameters of a stage. Only that stage and the stages after it get a new key and are recomputed.
+    """
+
+    STAGES = ["load", "typecast", "drop_sparse", "impute", "deskew", "outliers", "prune_correlated"]
+
+    # Class constructor
+    def __init__(self, path = "loan_payments.csv", cache_dir = ".pipeline_cache"):
+        self.path = path
+        self.cache_dir = cache_dir
+        self.params = {
+            "load": {"path": path},
+            "typecast": {"category_columns": DataTransform.CATEGORY_COLUMNS, "datetime_columns": DataTransform.DATETIME_COLUMNS},
+            "drop_sparse": {"columns": ["mths_since_last_delinq", "mths_since_last_record", "next_payment_date", "mths_since_last_major_derog"]},
+            "impute": {"mean_columns": DataFrameTransform.MEAN_COLUMNS, "median_columns": DataFrameTransform.MEDIAN_COLUMNS,
+                       "ffill_columns": DataFrameTransform.FFILL_COLUMNS, "mode_columns": DataFrameTransform.MODE_COLUMNS},
+            "deskew": {"log_columns": DataFrameTransform.LOG_COLUMNS, "sqrt_columns": DataFrameTransform.SQRT_COLUMNS},
+            "outliers": {"rules": DataFrameTransform.OUTLIER_RULES},
+            "prune_correlated": {"columns": ["funded_amount_inv", "instalment", "total_payment", "total_payment_inv", "total_rec_int", "out_prncp_inv"],
+                                 "threshold": 0.9},
+        }
+        self.frames = {}
+
+    def __getattr__(self, name):
+        if name in LoanPipeline.STAGES:
+            return self.get(name)
+        raise AttributeError(f"'LoanPipeline' object has no attribute '{name}'")
+
+    # Methods
+    def stage_key(self, stage):
+        index = self.STAGES.index(stage)
+        digest = hashlib.sha256()
+        if index == 0:
+            digest.update(TypedCache().fingerprint_file(self.params["load"]["path"]).encode())
+        else:
+            digest.update(self.stage_key(self.STAGES[index - 1]).encode())
+        digest.update(stage.encode())
+        digest.update(json.dumps(self.params[stage], sort_keys = True, default = str).encode())
+        for function in self.stage_functions(stage):
+            digest.update(code_fingerprint(function).encode())
+        return digest.hexdigest()[:16]
+
+    def stage_functions(self, stage):
+        # The functions whose code a stage depends on, so editing one of them invalidates the stage.
+        functions = {
+            "load": [csv_to_typed_df, parse_dates_cached],
+            "typecast": [DataTransform.change_data_type_category, DataTransform.change_data_type_datetime, parse_dates_cached],
+            "impute": [DataFrameTransform.impute_missing],
+            "deskew": [DataFrameTransform.reduce_skew],
+            "outliers": [DataFrameTransform.remove_outliers, OutlierRules.mask, OutlierRules.apply],
+            "prune_correlated": [DataFrameTransform.correlated_columns, DataFrameTransform.prune_correlated, CorrelationAccumulator.update,
+                                 CorrelationAccumulator.result],
+        }.get(stage, [])
+        return functions + [getattr(LoanPipeline, "run_" + stage)]
+
+    def get(self, stage):
+        key = self.stage_key(stage)
+        if stage in self.frames and self.frames[stage][0] == key:
+            return self.frames[stage][1]
+        cache = TypedCache(os.path.join(self.cache_dir, f"{stage}.feather"))
+        df = cache.load(key)
+        if df is None:
+            index = self.STAGES.index(stage)
+            previous = self.get(self.STAGES[index - 1]) if index else None
+            df = getattr(self, "run_" + stage)(previous, **self.params[stage])
+            os.makedirs(self.cache_dir, exist_ok = True)
+            cache.save(df, key)
+        self.frames[stage] = (key, df)
+        return df
+
+    def set_params(self, stage, **params):
+        self.params[stage] = {**self.params[stage], **params}
+
+    # Stages. Each one works on a copy so the memoized output of the previous stage is never modified.
+    def run_load(self, df, path):
+        return csv_to_typed_df(path)
+    def run_typecast(self, df, category_columns, datetime_columns):
+        transform = DataTransform(df.copy())
+        transform.CATEGORY_COLUMNS = category_columns
+        transform.DATETIME_COLUMNS = datetime_columns
+        return transform.change_data_type_datetime(transform.change_data_type_category(transform.df))
+    def run_drop_sparse(self, df, columns):
+        return df.drop(columns, axis = 1)
+    def run_impute(self, df, mean_columns, median_columns, ffill_columns, mode_columns):
+        transform = DataFrameTransform(df.copy())
+        transform.MEAN_COLUMNS, transform.MEDIAN_COLUMNS, transform.FFILL_COLUMNS, transform.MODE_COLUMNS = mean_columns, median_columns, ffill_columns, mode_columns
+        return transform.impute_missing(transform.df)
+    def run_deskew(self, df, log_columns, sqrt_columns):
+        transform = DataFrameTransform(df.copy())
+        transform.LOG_COLUMNS, transform.SQRT_COLUMNS = log_columns, sqrt_columns
+        return transform.reduce_skew(transform.df)
+    def run_outliers(self, df, rules):
+        return DataFrameTransform(df).remove_outliers(df, [tuple(rule) for rule in rules])
+    def run_prune_correlated(self, df, columns, threshold):
+        # With columns set to None the correlated columns are found automatically (see DataFrameTransform.prune_correlated).
+        if columns is None:
+            return DataFrameTransform(df).prune_correlated(df, threshold)
+        return df.drop(columns, axis = 1)
+
+pipeline = LoanPipeline()
+
+def __getattr__(name):
+    # payments_df and new_payments_df used to be built when this file was imported; they are now computed on first access.
+    if name == "payments_df":
+        return pipeline.impute
+    if name == "new_payments_df":
+        return pipeline.prune_correlated
+    raise AttributeError(f"module 'db_utils' has no attribute '{name}'")
+
+# DataFrameInfo(pipeline.impute).df_null_count(pipeline.impute)
 # There are now no NULL values in the data.
-# Plotter(payments_df).plot_null(payments_df)
+# Plotter(pipeline.impute).plot_null(pipeline.impute)
 # When running the above function we can see the NULL values have all been removed.
-payments_df.skew(numeric_only=True)
+# pipeline.impute.skew(numeric_only=True)
 # Columns wih high SKEW (over 2): annual_inc, delinq_2yrs, inq_last_6mths, out_prncp, out_prncp_inv, total_rec_int, total_rec_late_fee, recoveries, collection_recovery_fee, last_payment_amount.
-np.log(payments_df["last_payment_amount"]+1).skew()
-np.sqrt(payments_df["last_payment_amount"]).skew()
-new_payments_df = DataFrameTransform(payments_df).reduce_skew(payments_df)
-new_payments_df.skew(numeric_only=True)
+# np.log(pipeline.impute["last_payment_amount"]+1).skew()
+# np.sqrt(pipeline.impute["last_payment_amount"]).skew()
+# pipeline.deskew.skew(numeric_only=True)
 # When running the above function we can see that the columns' skewness has been reduced.
-# Plotter(new_payments_df).plot_data_boxplot(new_payments_df["loan_amount"])
-DataFrameInfo(new_payments_df).df_describe_data(new_payments_df["loan_amount"])
+# Plotter(pipeline.deskew).plot_data_boxplot(pipeline.deskew["loan_amount"])
+# DataFrameInfo(pipeline.deskew).df_describe_data(pipeline.deskew["loan_amount"])
 # Above 2 lines were used to identify outliers in the data.
-new_payments_df = DataFrameTransform(new_payments_df).remove_outliers(new_payments_df)
-DataFrameInfo(new_payments_df).df_shape(new_payments_df)
-# Plotter(new_payments_df).plot_data_boxplot(new_payments_df["open_accounts"])
+# DataFrameInfo(pipeline.outliers).df_shape(pipeline.outliers)
+# Plotter(pipeline.outliers).plot_data_boxplot(pipeline.outliers["open_accounts"])
 # When running the above function with different columns we can see that outliers have been removed.
-new_payments_df.corr(numeric_only=True)
+# pipeline.outliers.corr(numeric_only=True)
 # Hihghly correlated columns to remove.
 # loan_amount : funded_amount_inv, instalment, total_payment, total_payment_inv, total_rec_int
 # out_prncp: out_prncp_inv
-new_payments_df = new_payments_df.drop(["funded_amount_inv", "instalment", "total_payment", "total_payment_inv", "total_rec_int", "out_prncp_inv"], axis = 1)
-DataFrameInfo(new_payments_df).df_shape(new_payments_df)
+# These are dropped by the "prune_correlated" stage of LoanPipeline.
+# DataFrameInfo(pipeline.prune_correlated).df_shape(pipeline.prune_correlated)
 # When running the above function we can see that the 6 columns have been removed.
 # Save the transformed data base to a csv file.
-# new_payments_df.to_csv("transformed_data.csv")
+# pipeline.prune_correlated.to_csv("transformed_data.csv")
+
+class PandasBackend:
+    """
+    Computes the filters and aggregates used by the milestone tasks on a local data frame.
+
+    Parameters:
+    ----------
+    df: pandas dataframe
+        The data frame to compute on. The milestone tasks use pipeline.impute, remove_outliers needs a frame after reduce_skew.
+
+    Attributes:
+    ----------
+    df: pandas dataframe
+        Check Parameters section.
+
+    Methods:
+    ----------
+    sum(columns, statuses)
+        Returns a dictionary with the sum of each column over the loans with one of the given loan statuses (all loans when statuses is None).
+    count(statuses)
+        Returns the number of loans with one of the given loan statuses (all loans when statuses is None).
+    remove_outliers(rules)
+        Returns the rows which meet the outlier rules (DataFrameTransform.OUTLIER_RULES by default).
+    """
+
+    # Class constructor
+    def __init__(self, df):
+        self.df = df
+
+    # Methods
+    def rows(self, statuses):
+        return self.df if statuses is None else self.df[self.df["loan_status"].isin(statuses)]
+    def sum(self, columns, statuses = None):
+        rows = self.rows(statuses)
+        return {column: float(rows[column].sum()) for column in columns}
+    def count(self, statuses = None):
+        return len(self.rows(statuses))
+    def remove_outliers(self, rules = None):
+        return DataFrameTransform(self.df).remove_outliers(self.df, rules)
+
+class SQLBackend:
+    """
+    Compiles the filters and aggregates used by the milestone tasks into SQL and runs them in the database,
+    so only the aggregates, or the filtered rows, are transferred. Gives the same results as PandasBackend (sums up to floating point summation order).
+
+    Parameters:
+    ----------
+    engine: engine
+        Database engine, for example from RDSDatabaseConnector.SQLAlchemy or a local SQLite stand-in.
+    table_name: string
+        The raw (untransformed) loan payments table. Defaults to "loan_payments".
+
+    Attributes:
+    ----------
+    engine: engine
+        Check Parameters section.
+    table: Table
+        The reflected table.
+
+    Methods:
+    ----------
+    sum(columns, statuses)
+        Same as PandasBackend.sum. Columns which impute_missing fills with their mean are filled with their mean in SQL too,
+        so the sums match the imputed data frame.
+    count(statuses)
+        Same as PandasBackend.count.
+    outlier_condition(rules)
+        Compiles the outlier rules into a SQL condition on the raw columns. Rules on columns which reduce_skew transforms are inverted
+        instead (log(x+1) <= v becomes x <= exp(v)-1, sqrt(x) <= v becomes x <= v^2), so no maths functions are needed in the database.
+        A threshold below every transformed value (v < 0 for sqrt) keeps all rows for >= and > and none for <=, < and ==.
+        rules can also be an OutlierRules object (e.g. from OutlierRules.from_fences).
+        Rows where the transform would be undefined (NaN in pandas) are excluded, as they are by the pandas comparison.
+    remove_outliers(rules, columns)
+        Returns the raw rows (only the given columns, or all of them) which meet the outlier rules.
+    """
+
+    # Class constructor
+    def __init__(self, engine, table_name = "loan_payments"):
+        self.engine = engine
+        self.table = Table(table_name, MetaData(), autoload_with = engine)
+
+    # Methods
+    def column(self, name):
+        column = self.table.c[name]
+        if name in DataFrameTransform.MEAN_COLUMNS:
+            return func.coalesce(column, select(func.avg(column)).scalar_subquery())
+        return column
+    def where(self, query, statuses):
+        return query if statuses is None else query.where(self.table.c.loan_status.in_(statuses))
+
+    def sum(self, columns, statuses = None):
+        query = self.where(select(*[func.coalesce(func.sum(self.column(column)), 0) for column in columns]), statuses)
+        with self.engine.connect() as connection:
+            row = connection.execute(query).one()
+        return {column: float(value) for column, value in zip(columns, row)}
+    def count(self, statuses = None):
+        query = self.where(select(func.count()).select_from(self.table), statuses)
+        with self.engine.connect() as connection:
+            return connection.execute(query).scalar_one()
+
+    def outlier_condition(self, rules = None):
+        conditions = []
+        rules = rules.rules if isinstance(rules, OutlierRules) else rules or DataFrameTransform.OUTLIER_RULES
+        for column, op, value in rules:
+            raw = self.table.c[column]
+            below = False
+            if column in DataFrameTransform.LOG_COLUMNS:
+                conditions.append(raw > -1)
+                value = math.expm1(value)
+                below = value <= -1
+            elif column in DataFrameTransform.SQRT_COLUMNS:
+                conditions.append(raw >= 0)
+                below = value < 0
+                value = value ** 2
+            if below:
+                # Every transformed value is above the threshold (e.g. a negative lower fence on a sqrt column), so squaring it would be wrong.
+                if op in ("<=", "<", "=="):
+                    conditions.append(false())
+            else:
+                conditions.append(DataFrameTransform.OPERATORS[op](raw, value))
+        return and_(*conditions)
+    def remove_outliers(self, rules = None, columns = None):
+        selected = [self.table.c[column] for column in columns] if columns else [self.table]
+        with self.engine.connect() as connection:
+            return pd.read_sql_query(select(*selected).where(self.outlier_condition(rules)), connection)
+
+LATE_STATUSES = ["Late (16-30 days)", "Late (31-120 days)"]
+
+class LossAnalytics:
+    """
+    Computes the loss figures of the milestone 4 tasks for the whole portfolio or for any segment of it (grade, purpose, term, ...).
+    The derived columns are computed once per data frame and cached, without changing the data frame, and every figure of a segmentation
+    comes from a single groupby over them.
+
+    Parameters:
+    ----------
+    df: pandas dataframe
+        The imputed loan payments data frame (LoanPipeline "impute" stage).
+
+    Attributes:
+    ----------
+    df: pandas dataframe
+        Check Parameters section.
+    INPUT_COLUMNS: list
+        The columns of df which the derived columns are computed from.
+    DERIVED_CACHE: FrameCache
+        The derived columns of each data frame, shared by the LossAnalytics objects (a FrameCache like DataFrameInfo.PROFILE_CACHE).
+        Only INPUT_COLUMNS are hashed to check an entry, so they are recomputed when one of them has changed and a lookup stays cheap.
+    derived_columns: pandas dataframe
+        The derived columns this object got from DERIVED_CACHE, reused by every summary without checking df again.
+
+    Methods:
+    ----------
+    derived(refresh)
+        Returns a data frame (same index as df) with term_months, months_paid and months_left, the charged_off and late flags,
+        and the per-loan amounts the summary adds up. term is parsed once per category rather than once per row.
+        They are looked up in DERIVED_CACHE on the first call only; after editing df in place, call derived(refresh = True) or use a new object.
+    summary(by)
+        Returns one row per segment of the columns in by (a column name or a list, of df or of derived) or, with by set to None,
+        one row for the whole portfolio, with:
+        loans, funded_amount, total_payment, recovery_percentage, charged_off_count, charged_off_percentage, charged_off_payment,
+        interest_loss and unpaid_loss (revenue lost on the charged off loans), total_loss, late_count, late_percentage,
+        late_exposure (revenue lost if the late loans were charged off) and potential_loss (total_loss + late_exposure).
+    """
+
+    INPUT_COLUMNS = ["term", "issue_date", "last_payment_date", "loan_status", "last_payment_amount", "int_rate", "funded_amount", "total_payment"]
+    DERIVED_CACHE = FrameCache()
+
+    # Class constructor
+    def __init__(self, df):
+        self.df = df
+        self.derived_columns = None
+
+    # Methods
+    def derived(self, refresh = False):
+        df = self.df
+        def compute():
+            term = df["term"]
+            if isinstance(term.dtype, pd.CategoricalDtype):
+                months = pd.Series(term.cat.categories, dtype = "string").str.replace(r"\D", "", regex = True)
+                term_months = np.append(pd.to_numeric(months).to_numpy(np.float64), np.nan)[term.cat.codes.to_numpy()]
+            else:
+                term_months = pd.to_numeric(term.astype("string").str.replace(r"\D", "", regex = True)).to_numpy(np.float64, na_value = np.nan)
+            months_paid = ((df["last_payment_date"].dt.year - df["issue_date"].dt.year) * 12
+                           + (df["last_payment_date"].dt.month - df["issue_date"].dt.month)).to_numpy(np.float64, na_value = np.nan)
+            months_left = term_months - months_paid
+            charged_off = (df["loan_status"] == "Charged Off").to_numpy()
+            late = df["loan_status"].isin(LATE_STATUSES).to_numpy()
+            last_payment = df["last_payment_amount"].to_numpy(np.float64, na_value = np.nan)
+            unpaid = last_payment * months_left
+            interest = last_payment * np.power(1 + df["int_rate"].to_numpy(np.float64, na_value = np.nan) / 100, months_left / 12)
+            derived = pd.DataFrame({
+                "term_months": term_months,
+                "months_paid": months_paid,
+                "months_left": months_left,
+                "charged_off": charged_off,
+                "late": late,
+                "funded_amount": df["funded_amount"].to_numpy(np.float64, na_value = np.nan),
+                "total_payment": df["total_payment"].to_numpy(np.float64, na_value = np.nan),
+                "charged_off_payment": np.where(charged_off, df["total_payment"].to_numpy(np.float64, na_value = np.nan), 0.0),
+                "interest_loss": np.where(charged_off, interest, 0.0),
+                "unpaid_loss": np.where(charged_off, unpaid, 0.0),
+                "late_exposure": np.where(late, unpaid, 0.0),
+            }, index = df.index)
+            return derived
+        if refresh or self.derived_columns is None:
+            self.derived_columns = self.DERIVED_CACHE.get(df, "derived", compute, refresh, self.INPUT_COLUMNS)
+        return self.derived_columns
+
+    def summary(self, by = None):
+        derived = self.derived()
+        sums = ["charged_off", "late", "funded_amount", "total_payment", "charged_off_payment", "interest_loss", "unpaid_loss", "late_exposure"]
+        if by is None:
+            totals = derived[sums].sum().to_frame("all").T
+            totals.insert(0, "loans", len(derived))
+        else:
+            keys = [by] if isinstance(by, str) else list(by)
+            # The segment columns are passed as series, so neither frame is copied or joined.
+            groups = derived[sums].groupby([derived[key] if key in derived else self.df[key] for key in keys], observed = True, sort = True)
+            totals = groups.sum()
+            totals.insert(0, "loans", groups.size())
+        totals = totals.rename(columns = {"charged_off": "charged_off_count", "late": "late_count"})
+        totals["recovery_percentage"] = totals["total_payment"] / totals["funded_amount"] * 100
+        totals["charged_off_percentage"] = totals["charged_off_count"] / totals["loans"] * 100
+        totals["late_percentage"] = totals["late_count"] / totals["loans"] * 100
+        totals["total_loss"] = totals["interest_loss"] + totals["unpaid_loss"]
+        totals["potential_loss"] = totals["total_loss"] + totals["late_exposure"]
+        return totals[["loans", "funded_amount", "total_payment", "recovery_percentage", "charged_off_count", "charged_off_percentage",
+                       "charged_off_payment", "interest_loss", "unpaid_loss", "total_loss", "late_count", "late_percentage", "late_exposure",
+                       "potential_loss"]]
+
+class Instrumentation:
+    """
+    Records every call to the extraction, csv and transformation stages while it is enabled, to find where the time and memory of a run go.
+    The methods are replaced by timing wrappers in enable() and restored in disable(), so nothing is added to them when it is not used.
+    It can also be used as a context manager: with Instrumentation() as instrumentation: ...
+
+    Parameters:
+    ----------
+    trace_allocations: bool
+        Defaults to True, which runs tracemalloc while enabled to record the memory allocated by each call. This slows down code
+        which allocates many Python objects (reading sql or csv files), so set it to False for timings only.
+    memory_report: bool
+        Defaults to True, which records df.memory_usage(deep = True) of the data frame returned by each call (per column, with its dtype).
+
+    Attributes:
+    ----------
+    trace_allocations, memory_report: bool
+        Check Parameters section.
+    records: list
+        One dictionary per call with name, start (seconds since enable), wall_seconds, cpu_seconds (of the whole process), thread, rows_in, rows_out,
+        allocated_bytes (still allocated when the call returned), peak_bytes (highest allocation above the start of the call),
+        peak_rss_mb (of the process so far) and memory (the memory report of the returned data frame).
+    TARGETS: dictionary
+        The methods of each class which are instrumented. The module functions in FUNCTIONS are replaced in this module,
+        so they are recorded when called from here (for example by LoanPipeline) but not through a name imported elsewhere beforehand.
+
+    Methods:
+    ----------
+    enable()
+        Starts recording.
+    disable()
+        Stops recording and restores the original methods.
+    summary()
+        Returns the records as a data frame (without the memory reports).
+    memory_frame()
+        Returns the memory reports as a data frame with one row per call and column: name, call, column, dtype and bytes.
+    to_json(path)
+        Writes the records to a JSON file.
+    to_chrome_trace(path)
+        Writes the records as a Chrome trace (chrome://tracing or https://ui.perfetto.dev), one slice per call, plus a counter
+        of the peak RSS.
+    """
+
+    TARGETS = {
+        RDSDatabaseConnector: ["extract_data", "save_csv", "extract_data_chunked", "extract_data_cached", "sync_incremental", "extract_data_partitioned"],
+        DataTransform: ["change_data_type_category", "change_data_type_datetime"],
+        DataFrameTransform: ["impute_missing", "reduce_skew", "remove_outliers", "prune_correlated"],
+    }
+    FUNCTIONS = ["csv_to_df", "csv_to_typed_df", "load_typed_df"]
+
+    # Class constructor
+    def __init__(self, trace_allocations = True, memory_report = True):
+        self.trace_allocations = trace_allocations
+        self.memory_report = memory_report
+        self.records = []
+        self.originals = []
+        self.started_tracing = False
+        self.local = threading.local()
+
+    def __enter__(self):
+        return self.enable()
+    def __exit__(self, *exc_info):
+        self.disable()
+
+    # Methods
+    def enable(self):
+        if self.originals:
+            return self
+        for owner, names in self.TARGETS.items():
+            for name in names:
+                self.originals.append((owner, name, owner.__dict__[name]))
+                setattr(owner, name, self.wrap(f"{owner.__name__}.{name}", owner.__dict__[name]))
+        module = sys.modules[__name__]
+        for name in self.FUNCTIONS:
+            self.originals.append((module, name, getattr(module, name)))
+            setattr(module, name, self.wrap(name, getattr(module, name)))
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        self.origin = time.perf_counter()
+        return self
+
+    def disable(self):
+        for owner, name, original in reversed(self.originals):
+            setattr(owner, name, original)
+        self.originals = []
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def rows(self, value):
+        # Number of rows of a data frame or series, of the first one in a tuple (e.g. extract_data_partitioned), or of a report dictionary.
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            return len(value)
+        if isinstance(value, tuple):
+            return next((len(item) for item in value if isinstance(item, (pd.DataFrame, pd.Series))), None)
+        if isinstance(value, dict) and isinstance(value.get("rows"), int):
+            return value["rows"]
+        return None
+
+    def wrap(self, name, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            tracing = tracemalloc.is_tracing()
+            # Each call keeps the highest allocation seen while it runs; tracemalloc has a single peak, which is reset for every nested call.
+            stack = self.local.__dict__.setdefault("stack", [])
+            if tracing:
+                current, peak = tracemalloc.get_traced_memory()
+                if stack:
+                    stack[-1][1] = max(stack[-1][1], peak)
+                tracemalloc.reset_peak()
+                stack.append([current, current])
+            start, cpu_start = time.perf_counter(), time.process_time()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+                rows_in = next((len(arg) for arg in args if isinstance(arg, (pd.DataFrame, pd.Series))), None)
+                record = {"name": name, "start": start - self.origin, "wall_seconds": wall, "cpu_seconds": cpu, "thread": threading.get_ident(),
+                          "rows_in": rows_in, "rows_out": None, "allocated_bytes": None, "peak_bytes": None, "peak_rss_mb": peak_rss_mb(), "memory": None}
+                if tracing:
+                    current, peak = tracemalloc.get_traced_memory()
+                    entry, running = stack.pop()
+                    peak = max(running, peak)
+                    if stack:
+                        stack[-1][1] = max(stack[-1][1], peak)
+                    record["allocated_bytes"] = current - entry
+                    record["peak_bytes"] = peak - entry
+                self.records.append(record)
+            record["rows_out"] = self.rows(result)
+            if self.memory_report and isinstance(result, pd.DataFrame):
+                usage = result.memory_usage(deep = True, index = False)
+                record["memory"] = [{"column": str(column), "dtype": str(result[column].dtype), "bytes": int(usage[column])} for column in usage.index]
+            return result
+        return wrapper
+
+    def summary(self):
+        return pd.DataFrame([{key: value for key, value in record.items() if key != "memory"} for record in self.records])
+    def memory_frame(self):
+        rows = [{"name": record["name"], "call": number, **column} for number, record in enumerate(self.records) for column in record["memory"] or []]
+        return pd.DataFrame(rows, columns = ["name", "call", "column", "dtype", "bytes"])
+
+    def to_json(self, path = "instrumentation.json"):
+        with open(path, "w") as json_file:
+            json.dump({"pid": os.getpid(), "records": self.records}, json_file, indent = 1)
+        return path
+    def to_chrome_trace(self, path = "instrumentation.trace.json"):
+        events = []
+        for record in self.records:
+            args = {key: value for key, value in record.items() if key not in ("name", "start", "wall_seconds", "thread", "memory")}
+            if record["memory"]:
+                args["memory_bytes"] = sum(column["bytes"] for column in record["memory"])
+            events.append({"name": record["name"], "cat": "stage", "ph": "X", "ts": record["start"] * 1e6, "dur": record["wall_seconds"] * 1e6,
+                           "pid": os.getpid(), "tid": record["thread"], "args": args})
+            if record["peak_rss_mb"] is not None:
+                events.append({"name": "peak_rss_mb", "ph": "C", "ts": (record["start"] + record["wall_seconds"]) * 1e6, "pid": os.getpid(),
+                               "args": {"peak_rss_mb": record["peak_rss_mb"]}})
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+        return path
 
 # Milestone 4, Task 1
 # total_payment, funded_amount_inv, funded_amount
-def milestone4_task1():
-    total_payment = payments_df["total_payment"].sum()
-    funded_amount = payments_df["funded_amount"].sum()
+# Tasks 1, 2 and 4 take an optional backend, e.g. SQLBackend(engine) to compute the aggregates in the database instead of locally.
+# In task 4 the backend only covers the late loan counts; the revenue figures need the local data (see milestone4_task4).
+def milestone4_task1(backend = None):
+    backend = backend or PandasBackend(pipeline.impute)
+    sums = backend.sum(["total_payment", "funded_amount"])
+    total_payment = sums["total_payment"]
+    funded_amount = sums["funded_amount"]
     percentage_recovered = (total_payment / funded_amount) * 100
     print(f"The percentage of money recovered is{percentage_recovered}%")
     df = pd.DataFrame([total_payment, funded_amount])
@@ -319,44 +2142,53 @@ def milestone4_task1():
 
 # Milestone 4, Task 2
 # total_payment, loan_status, funded_amount
-def milestone4_task2():
-    charged_off_total = payments_df.loc[payments_df["loan_status"] == "Charged Off", "total_payment"].sum()
-    charged_off_count = payments_df[(payments_df["loan_status"] == "Charged Off")].shape[0]
+def milestone4_task2(backend = None):
+    backend = backend or PandasBackend(pipeline.impute)
+    charged_off_total = backend.sum(["total_payment"], ["Charged Off"])["total_payment"]
+    charged_off_count = backend.count(["Charged Off"])
     print(f"The amount of charged off loans is {charged_off_count}")
     print(f"The amount of money paid towards these loans is £{round(charged_off_total, 2)}")
-    percentage = round((charged_off_count/36408) * 100, 2)
+    percentage = round((charged_off_count/backend.count()) * 100, 2)
     print(f"The percentage of charged off loans is {percentage}%")
-# milestone4_task2() - 15.3% is the percetage of charged off loans, amount paid was £37,400,589.
+# milestone4_task2() - prints the number of charged off loans, the amount paid towards them and their percentage of all the loans in pipeline.impute.
+# (The 15.3% and £37,400,589 noted before were taken from the skew-reduced data, out of the 36408 loans left after removing outliers.)
 
 # Milestone 4, Task 3
 # total_payment, loan_status, funded_amount, last_payment_amount, term, issue_date, last_payment_date, int_rate
-def milestone4_task3():
-    payments_df["term"] = payments_df["term"].str.replace(r'\D', '', regex=True).astype(np.float64)
-    payments_df["months_paid"] = (payments_df["last_payment_date"].dt.year - payments_df["issue_date"].dt.year) * 12 + (payments_df["last_payment_date"].dt.month - payments_df["issue_date"].dt.month)
-    charged_off = payments_df[(payments_df["loan_status"] == "Charged Off")]
-    payments_df["months_left"] = payments_df["term"] - payments_df["months_paid"]
-    charged_off["revenue_lost"] = charged_off["last_payment_amount"]*pow(1+(charged_off["int_rate"]/100), (payments_df["months_left"]/12))
-    revenue_lost_int = charged_off["revenue_lost"].sum()
+# Tasks 3 and 4 take an optional segment, e.g. "grade" or ["purpose", "term"], to break the losses down (see LossAnalytics.summary).
+def milestone4_task3(by = None):
+    summary = LossAnalytics(pipeline.impute).summary(by)
+    if by is not None:
+        return summary[["charged_off_count", "interest_loss", "total_loss"]]
+    revenue_lost_int = summary["interest_loss"].iloc[0]
     print(f"The amount of revenue lost on charged off loans due to interest is £{round(revenue_lost_int, 2)}")
-    charged_off["unpaid_loss"] = charged_off["last_payment_amount"]*payments_df["months_left"]
-    revenue_lost_total = charged_off["unpaid_loss"].sum() + revenue_lost_int
+    revenue_lost_total = summary["total_loss"].iloc[0]
     print(f"The total amount lost is £{round(revenue_lost_total, 2)}")
-# milestone4_task3() - £38,978.40 is lost due to interest, £680297.51 is lost overall.
+    return summary
+# milestone4_task3() - prints the revenue lost on the charged off loans due to interest and the total lost (interest_loss and total_loss).
+# (The £38,978.40 and £680297.51 noted before were computed from the skew-reduced last_payment_amount and int_rate, so they are not money amounts.)
 
 # Milestone 4, Task 4
 # total_payment, loan_status, funded_amount, last_payment_amount, term, issue_date, last_payment_date, int_rate
-def milestone4_task4(revenue_lost_total):
-    late_count = payments_df[(payments_df["loan_status"] == "Late (16-30 days)") | (payments_df["loan_status"] == "Late (31-120 days)")].shape[0]
+def milestone4_task4(revenue_lost_total, backend = None, by = None):
+    if by is not None:
+        if backend is not None:
+            raise ValueError("The segmented figures are computed from the local data and cannot use a backend")
+        return LossAnalytics(pipeline.impute).summary(by)[["late_count", "late_percentage", "late_exposure", "potential_loss"]]
+    counts = backend or PandasBackend(pipeline.impute)
+    late_count = counts.count(LATE_STATUSES)
     print(f"The number of late payments is {late_count}")
-    percentage_late = round((late_count/36408) * 100, 2)
+    percentage_late = round((late_count/counts.count()) * 100, 2)
     print(f"The percentage of late payments out of the total is {percentage_late}%")
-    payments_df["term"] = payments_df["term"].str.replace(r'\D', '', regex=True).astype(np.float64)
-    payments_df["months_paid"] = (payments_df["last_payment_date"].dt.year - payments_df["issue_date"].dt.year) * 12 + (payments_df["last_payment_date"].dt.month - payments_df["issue_date"].dt.month)
-    payments_df["months_left"] = payments_df["term"] - payments_df["months_paid"]
-    late_payments = payments_df[(payments_df["loan_status"] == "Late (16-30 days)") | (payments_df["loan_status"] == "Late (31-120 days)")]
-    late_payments["revenue_lost"] = late_payments["last_payment_amount"]*late_payments["months_left"]
-    revenue_lost = late_payments["revenue_lost"].sum()
+    if backend is not None:
+        # The revenue lost needs the months left on each loan (LossAnalytics), which is only computed locally.
+        # Mixing it with the database counts could combine two different versions of the data, so only the counts are given.
+        print("The potential revenue loss is only computed from the local data; call milestone4_task4 without a backend for it.")
+        return
+    revenue_lost = LossAnalytics(pipeline.impute).summary()["late_exposure"].iloc[0]
     print(f"The potential revenue loss if late customers were charged off is £{round(revenue_lost, 2)}")
     revenue_lost_total = revenue_lost_total + revenue_lost
     print(f"The potential revenue loss if late customers were charged off and current charged off customers is £{round(revenue_lost_total, 2)}")
-# milestone4_task4(680297.51) - 1.88% of payments are late, £52,970.53 would be lost if late customers would be charged off, including already charged off customers this totals up to £733268.04.
\ No newline at end of file
+# milestone4_task4(total_loss) - with the total_loss of milestone4_task3(), prints the number and percentage of late loans, the revenue lost
+# if the late customers were charged off and that loss added to total_loss.
+# (The 1.88%, £52,970.53 and £733268.04 noted before were out of the 36408 loans left after removing outliers, using the skew-reduced columns.)
\ No newline at end of file
@@ -0,0 +1,19 @@
+import pytest
+from sqlalchemy import create_engine
+from db_utils import RDSDatabaseConnector
+from benchmark import load_database
+
+ROWS = 3000
+
+@pytest.fixture(scope = "module")
+def engine(tmp_path_factory):
+    return load_database(create_engine(f"sqlite:///{tmp_path_factory.mktemp('extract') / 'loans.db'}"), ROWS, seed = 5)
+
+@pytest.mark.parametrize("chunksize", [7, 1000, ROWS, 10 * ROWS])
+def test_chunked_extract_writes_the_save_csv_file(engine, tmp_path, monkeypatch, chunksize):
+    monkeypatch.chdir(tmp_path)
+    connector = RDSDatabaseConnector(None)
+    connector.save_csv(connector.extract_data(engine))
+    report = connector.extract_data_chunked(engine, str(tmp_path / "chunked.csv"), chunksize = chunksize)
+    assert report["rows"] == ROWS and report["rss_growth_mb"] >= 0
+    assert (tmp_path / "chunked.csv").read_bytes() == (tmp_path / "loan_payments.csv").read_bytes()
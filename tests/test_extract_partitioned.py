@@ -0,0 +1,58 @@
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+import db_utils
+from db_utils import RDSDatabaseConnector
+from benchmark import load_database
+
+ROWS = 2000
+
+@pytest.fixture(scope = "module")
+def engine(tmp_path_factory):
+    return load_database(create_engine(f"sqlite:///{tmp_path_factory.mktemp('partitioned') / 'loans.db'}"), ROWS, seed = 6)
+
+@pytest.fixture
+def failing_reads(monkeypatch):
+    # Makes the first read of each listed partition (by lower key bound) fail with an OperationalError, and skips the retry delays.
+    read_sql_query = pd.read_sql_query
+    failures = {}
+    def flaky(query, connection, *args, **kwargs):
+        lower = query.whereclause.clauses[0].right.value
+        if failures.get(lower, 0) > 0:
+            failures[lower] -= 1
+            raise OperationalError(str(query), {}, Exception("connection reset"))
+        return read_sql_query(query, connection, *args, **kwargs)
+    monkeypatch.setattr(db_utils.pd, "read_sql_query", flaky)
+    monkeypatch.setattr(db_utils.time, "sleep", lambda seconds: None)
+    return failures
+
+def test_partitions_are_retried_and_assembled_in_key_order(engine, failing_reads):
+    connector = RDSDatabaseConnector(None)
+    expected = connector.extract_data(engine).sort_values("id", ignore_index = True)
+    first = RDSDatabaseConnector(None).extract_data_partitioned(engine, partitions = 5, workers = 2, retries = 0)[1]
+    failing_reads.update({first[1]["lower"]: 1, first[3]["lower"]: 2})
+    loan_payments, report = connector.extract_data_partitioned(engine, partitions = 5, workers = 2, retries = 2)
+    pd.testing.assert_frame_equal(loan_payments, expected)
+    assert [timing["lower"] for timing in report] == sorted(timing["lower"] for timing in report)
+    assert [timing["attempts"] for timing in report] == [1, 2, 1, 3, 1]
+
+def test_partition_failing_every_retry_raises(engine, failing_reads):
+    lower = RDSDatabaseConnector(None).extract_data_partitioned(engine, partitions = 4, workers = 2)[1][2]["lower"]
+    failing_reads[lower] = 3
+    with pytest.raises(OperationalError):
+        RDSDatabaseConnector(None).extract_data_partitioned(engine, partitions = 4, workers = 2, retries = 2)
+
+def test_streamed_csv_matches_the_data_frame(engine, tmp_path):
+    connector = RDSDatabaseConnector(None)
+    loan_payments, _ = connector.extract_data_partitioned(engine, partitions = 3, workers = 2)
+    loan_payments.to_csv(tmp_path / "frame.csv")
+    assert connector.extract_data_partitioned(engine, partitions = 3, workers = 2, path = str(tmp_path / "partitioned.csv"))[0] is None
+    assert (tmp_path / "partitioned.csv").read_bytes() == (tmp_path / "frame.csv").read_bytes()
+
+def test_empty_table_writes_the_csv(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'empty.db'}")
+    pd.DataFrame({"id": pd.Series(dtype = "int64"), "loan_amount": pd.Series(dtype = "float64")}).to_sql("loan_payments", engine, index = False)
+    loan_payments, report = RDSDatabaseConnector(None).extract_data_partitioned(engine, path = str(tmp_path / "empty.csv"))
+    assert loan_payments is None and report == []
+    assert list(pd.read_csv(tmp_path / "empty.csv", index_col = 0).columns) == ["id", "loan_amount"]
@@ -0,0 +1,17 @@
+import pandas as pd
+from db_utils import DataFrameInfo
+from benchmark import loan_payments_frame
+
+def test_profile_of_a_column_matches_the_frame_profile():
+    df = loan_payments_frame(2000, seed = 4)
+    info = DataFrameInfo(df)
+    column = info.profile(df["loan_amount"])["columns"]
+    assert list(column.index) == ["loan_amount"]
+    pd.testing.assert_series_equal(column.loc["loan_amount"], info.profile(df)["columns"].loc["loan_amount"])
+
+def test_profile_cache_sees_in_place_edits():
+    df = loan_payments_frame(2000, seed = 4)
+    info = DataFrameInfo(df)
+    assert info.profile(df)["columns"].loc["loan_amount", "min"] > 0
+    df.loc[0, "loan_amount"] = -1
+    assert info.profile(df)["columns"].loc["loan_amount", "min"] == -1
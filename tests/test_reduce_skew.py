@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+from db_utils import DataFrameTransform
+from benchmark import measure, skew_frame
+
+ROWS = 500_000
+
+def test_in_place_matches_serial_with_one_column_of_extra_memory():
+    serial, _, serial_peak = measure(DataFrameTransform(None).reduce_skew, skew_frame(ROWS))
+    in_place, _, peak = measure(DataFrameTransform(None).reduce_skew, skew_frame(ROWS), workers = 2)
+    pd.testing.assert_frame_equal(serial, in_place, rtol = 1e-12)
+    column_mb = ROWS * np.dtype(np.float64).itemsize / 1024 ** 2
+    # The serial mode copies the rest of the block on its first assignment; the in-place mode keeps about one column alive.
+    assert serial_peak > 5 * column_mb
+    assert peak < 2.5 * column_mb
+
+def test_in_place_leaves_frames_sharing_the_data_unchanged():
+    df = skew_frame(1000)
+    before = df.copy()
+    alias = df.iloc[:]
+    DataFrameTransform(alias).reduce_skew(alias, workers = 2)
+    pd.testing.assert_frame_equal(df, before)
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+from db_utils import QuantileSketch, DistinctCounter, DataFrameInfo
+
+QUANTILES = np.linspace(0.01, 0.99, 99)
+
+def rank_error(values, estimates):
+    # Largest distance between the requested and the true rank of the estimates, as a share of the row count.
+    ranks = np.searchsorted(np.sort(values), estimates) / len(values)
+    return np.abs(ranks - QUANTILES).max()
+
+@pytest.mark.parametrize("k", [50, 200])
+@pytest.mark.parametrize("chunk_size", [1000, 50_000, 400_000])
+def test_quantile_sketch_rank_error(k, chunk_size):
+    values = np.random.default_rng(k + chunk_size).lognormal(8, 1.5, 400_000)
+    updated = QuantileSketch(k)
+    merged = QuantileSketch(k)
+    for number, start in enumerate(range(0, len(values), chunk_size)):
+        updated.update(values[start:start + chunk_size])
+        merged.merge(QuantileSketch(k, seed = number).update(values[start:start + chunk_size]))
+    for sketch in (updated, merged):
+        assert sketch.n == len(values) and sketch.min == values.min() and sketch.max == values.max()
+        assert rank_error(values, [sketch.quantile(q) for q in QUANTILES]) <= 2 / k
+        assert sum(map(len, sketch.levels)) <= sum(sketch.capacity(level) for level in range(len(sketch.levels)))
+
+def test_approx_profile_matches_exact_within_bounds():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"amount": rng.lognormal(8, 1.5, 200_000), "grade": rng.integers(0, 5000, 200_000)})
+    chunks = (df.iloc[start:start + 1000] for start in range(0, len(df), 1000))
+    result = DataFrameInfo(df).approx_profile(chunks, quantiles = tuple(QUANTILES), workers = 2)
+    estimates = result.loc["amount", [f"{q * 100:g}%" for q in QUANTILES]].astype(float)
+    assert rank_error(df["amount"].to_numpy(), estimates) <= 2 / 200
+    assert abs(result.loc["grade", "distinct"] / df["grade"].nunique() - 1) <= 3 * 1.04 / np.sqrt(2 ** 14)
+
+def test_approx_profile_of_a_column():
+    rng = np.random.default_rng(1)
+    amount = pd.Series(rng.lognormal(8, 1.5, 50_000), name = "amount")
+    result = DataFrameInfo(amount.to_frame()).approx_profile(amount, quantiles = tuple(QUANTILES), workers = 2)
+    assert list(result.index) == ["amount"] and result.loc["amount", "count"] == len(amount)
+
+def test_distinct_counter_relative_error():
+    counter = DistinctCounter()
+    for start in range(0, 1_000_000, 100_000):
+        counter.update(pd.Series(np.arange(start, start + 100_000) * 7919 % 1_000_003))
+    assert abs(counter.count() / 1_000_000 - 1) <= 3 * 1.04 / np.sqrt(2 ** 14)
@@ -0,0 +1,43 @@
+import pytest
+from sqlalchemy import create_engine
+from db_utils import LoanPipeline, DataFrameInfo, DataFrameTransform, OutlierRules, PandasBackend, SQLBackend
+from benchmark import load_database, write_csv
+
+ROWS = 20_000
+
+@pytest.fixture(scope = "module")
+def backends(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("backends")
+    engine = create_engine(f"sqlite:///{directory / 'loans.db'}")
+    load_database(engine, ROWS, seed = 3)
+    pipeline = LoanPipeline(write_csv(ROWS, str(directory / "loan_payments.csv"), seed = 3), str(directory / "cache"))
+    return pipeline, SQLBackend(engine)
+
+def test_sum_and_count_match_pandas(backends):
+    pipeline, sql = backends
+    local = PandasBackend(pipeline.impute)
+    columns = ["loan_amount", "funded_amount", "total_payment", "int_rate"]
+    for statuses in [None, ["Charged Off"], ["Late (16-30 days)", "Late (31-120 days)"]]:
+        assert sql.count(statuses) == local.count(statuses)
+        assert sql.sum(columns, statuses) == pytest.approx(local.sum(columns, statuses), rel = 1e-9)
+
+@pytest.mark.parametrize("method", ["default", "iqr", "zscore"])
+def test_remove_outliers_matches_pandas(backends, method):
+    pipeline, sql = backends
+    if method == "default":
+        rules = None
+    else:
+        # Fences on the transformed columns are often negative (below every sqrt), which the SQL inversion has to handle.
+        stats = DataFrameInfo(pipeline.deskew).profile(pipeline.deskew)["columns"]
+        rules = OutlierRules.from_fences(stats, ["inq_last_6mths", "total_rec_int", "annual_inc", "open_accounts"], method)
+    kept = PandasBackend(pipeline.deskew).remove_outliers(rules)
+    assert 0 < len(kept) < ROWS
+    assert sorted(sql.remove_outliers(rules, ["id"])["id"]) == sorted(kept["id"])
+
+def test_threshold_below_the_transformed_range(backends):
+    pipeline, sql = backends
+    for op, kept in [(">=", True), (">", True), ("<=", False), ("<", False), ("==", False)]:
+        rules = [("inq_last_6mths", op, -1.5), ("annual_inc", op, -800.0)]
+        expected = PandasBackend(pipeline.deskew).remove_outliers(rules)
+        assert len(sql.remove_outliers(rules, ["id"])) == len(expected)
+        assert (len(expected) > 0) == kept
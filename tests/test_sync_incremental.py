@@ -0,0 +1,39 @@
+import pandas as pd
+from sqlalchemy import create_engine, text
+from db_utils import RDSDatabaseConnector, TypedCache, DataTransform
+from benchmark import loan_payments_frame
+
+def typed_table(engine):
+    df = pd.read_sql_table("loan_payments", engine)
+    transform = DataTransform(df)
+    return transform.change_data_type_datetime(transform.change_data_type_category(df)).sort_values("id", ignore_index = True)
+
+def test_sync_incremental_fetches_inserts_and_updates(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'loans.db'}")
+    loan_payments_frame(2000, seed = 1).to_sql("loan_payments", engine, index = False)
+    cache = TypedCache(str(tmp_path / "loan_payments.feather"))
+    connector = RDSDatabaseConnector(None)
+    report = connector.sync_incremental(engine, cache)
+    assert report["mode"] == "full" and report["rows_total"] == 2000
+
+    # A run without changes fetches the rows of the watermark date again but reports none of them as updated.
+    report = connector.sync_incremental(engine, cache)
+    assert report["rows_inserted"] == 0 and report["rows_updated"] == 0 and report["rows_unchanged"] == report["rows_fetched"]
+
+    new_rows = loan_payments_frame(5, seed = 2, start = 5000)
+    new_rows.to_sql("loan_payments", engine, index = False, if_exists = "append")
+    with engine.begin() as connection:
+        # 01/01/2023 is after the watermark (December 2022) although it sorts before it as text.
+        low_id = connection.execute(text("SELECT MIN(id) FROM loan_payments")).scalar_one()
+        connection.execute(text("UPDATE loan_payments SET last_credit_pull_date = '01/01/2023', total_payment = 123.45 WHERE id = :id"), {"id": low_id})
+    report = connector.sync_incremental(engine, cache)
+    assert report["mode"] == "incremental"
+    assert report["rows_inserted"] == 5 and report["rows_updated"] == 1 and report["rows_total"] == 2005
+    assert report["rows_fetched"] < 2000
+    cached = cache.load(None)
+    assert cached.loc[cached["id"] == low_id, "total_payment"].iloc[0] == 123.45
+    pd.testing.assert_frame_equal(cached, typed_table(engine), check_categorical = False)
+
+    # The updated row is now the watermark, so only rows pulled on 01/01/2023 are fetched again.
+    report = connector.sync_incremental(engine, cache)
+    assert report["rows_fetched"] == 1 and report["rows_updated"] == 0
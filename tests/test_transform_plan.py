@@ -0,0 +1,21 @@
+from db_utils import TransformPlan, csv_to_typed_df
+from benchmark import loan_payments_frame
+
+SPARSE_COLUMNS = ["mths_since_last_delinq", "mths_since_last_record", "next_payment_date", "mths_since_last_major_derog"]
+
+def typed(df, path):
+    df.to_csv(path)
+    return csv_to_typed_df(str(path)).drop(SPARSE_COLUMNS, axis = 1)
+
+def test_transform_fills_categories_missing_from_a_small_batch(tmp_path):
+    history = typed(loan_payments_frame(2000, seed = 3), tmp_path / "history.csv")
+    plan = TransformPlan().fit(history)
+    assert plan.fill_values["term"] == "36 months"
+
+    # A daily delta of 60 month loans only, one of them without a term.
+    delta = loan_payments_frame(200, seed = 4, start = 2000)
+    delta = delta[delta["term"] == "60 months"].head(5).copy()
+    delta.iloc[0, delta.columns.get_loc("term")] = None
+    batch, _ = plan.transform(typed(delta, tmp_path / "delta.csv"), remove_outliers = False)
+    assert batch["term"].tolist()[0] == "36 months"
+    assert batch["term"].notna().all()